@@ -1,53 +1,82 @@
-from flask import Flask, render_template, request, redirect, url_for, session, abort, send_from_directory, flash
+from flask import Flask, Request, render_template, request, redirect, url_for, session, abort, send_file, send_from_directory, flash, g, jsonify, make_response
+import functools
+import hashlib
+import mimetypes
 import os
-import sqlite3
-from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+import click
+from datetime import datetime, timezone
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+
+import migrations
+import roadmap
+import uploads
+from content import summarize, backfill_summaries, split_tags
+from db import ConnectionPool
+import images
+from image_cache import DiskLRUCache
+from images import attach_variants, backfill_variants, fetch_variants, generate_variants, store_image_meta, strip_metadata
+from jobs import JobQueue
+from page_cache import PageCache
+from static_assets import AssetManifest, is_compressible, pick_encoding, precompress
+from search import search_posts, rebuild_index, optimize_index
+from tags import set_post_tags, fetch_post_tags, fetch_tag, fetch_tag_posts_page
+
+
+DATABASE_PATH = os.environ.get('BLOG_DB_PATH', os.path.join(os.path.dirname(__file__), 'blog.db'))
+
+# SQLite tuning, overridable per deployment
+db_pool = ConnectionPool(
+    DATABASE_PATH,
+    max_idle=int(os.environ.get('SQLITE_POOL_SIZE', 8)),
+    pragmas={
+        'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+        'cache_size': int(os.environ.get('SQLITE_CACHE_SIZE', -16000)),
+        'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 268435456)),
+        'temp_store': os.environ.get('SQLITE_TEMP_STORE', 'MEMORY'),
+        'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)),
+    },
+)
 
 
 def get_db_connection():
-    connection = sqlite3.connect(os.path.join(os.path.dirname(__file__), 'blog.db'))
-    connection.row_factory = sqlite3.Row
-    return connection
+    """Return the pooled connection bound to the current app context."""
+    if 'db' not in g:
+        g.db = db_pool.acquire()
+    return g.db
 
 
 def init_db():
+    """Bring blog.db up to the latest schema version."""
     with get_db_connection() as conn:
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS posts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                title TEXT,
-                content TEXT,
-                date TEXT
-            )
-            """
-        )
-        # Ensure image column exists
-        cols = conn.execute('PRAGMA table_info(posts)').fetchall()
-        col_names = {c[1] for c in cols}
-        if 'image' not in col_names:
-            conn.execute('ALTER TABLE posts ADD COLUMN image TEXT')
-        # Resources table
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS resources (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                title TEXT NOT NULL,
-                url TEXT NOT NULL,
-                order_index INTEGER NOT NULL
-            )
-            """
-        )
-        # Ensure new roadmap columns exist
-        res_cols = conn.execute('PRAGMA table_info(resources)').fetchall()
-        res_col_names = {c[1] for c in res_cols}
-        if 'branch' not in res_col_names:
-            conn.execute("ALTER TABLE resources ADD COLUMN branch TEXT DEFAULT 'main'")
-        if 'parent_id' not in res_col_names:
-            conn.execute('ALTER TABLE resources ADD COLUMN parent_id INTEGER NULL')
-        conn.commit()
+        return migrations.migrate(conn, DATABASE_PATH + '.migrate.lock')
+
+
+class UploadRequest(Request):
+    """Streams file parts to disk through uploads.IncomingFile.
+
+    Werkzeug's default buffers small parts in memory and then copies them
+    when the view calls save(); here each part is hashed, type-checked and
+    size-capped while it is being received.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.incoming_files = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        max_bytes = app.config['MAX_UPLOAD_BYTES']
+        if content_length and max_bytes is not None and content_length > max_bytes:
+            raise RequestEntityTooLarge(f'Uploaded files are limited to {max_bytes} bytes.')
+        incoming = uploads.IncomingFile(app.config['UPLOAD_FOLDER'], app.config['INCOMING_FOLDER'], max_bytes)
+        self.incoming_files.append(incoming)
+        return incoming
+
+    def close(self):
+        super().close()
+        # Parts that were never ingested, including ones cut off by an error
+        for incoming in self.incoming_files:
+            incoming.discard()
 
 
 app = Flask(
@@ -58,25 +87,331 @@ app = Flask(
 )
 
 # Configure uploads
-UPLOAD_FOLDER = os.path.join(os.path.dirname(__file__), 'static', 'uploads')
+UPLOAD_FOLDER = uploads.UPLOAD_FOLDER
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif", "webp"}
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['INCOMING_FOLDER'] = uploads.INCOMING_FOLDER
+# Per-file and per-request caps; werkzeug answers 413 past either one
+app.config['MAX_UPLOAD_BYTES'] = int(os.environ.get('MAX_UPLOAD_BYTES', 10 * 1024 * 1024))
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 12 * 1024 * 1024))
+app.request_class = UploadRequest
+
+
+# Post-save work (image variants, upload GC) runs on worker threads;
+# finished jobs are kept JOB_RETENTION_DAYS for inspection
+job_queue = JobQueue(
+    db_pool,
+    workers=int(os.environ.get('JOB_WORKERS', 2)),
+    retain_for=float(os.environ.get('JOB_RETENTION_DAYS', 7)) * 24 * 3600,
+)
+
+# Orphaned uploads older than the grace period are reclaimable; set
+# UPLOAD_GC_INTERVAL (seconds) to sweep them from the job queue.
+UPLOAD_GC_GRACE = float(os.environ.get('UPLOAD_GC_GRACE_HOURS', 24)) * 3600
+UPLOAD_GC_INTERVAL = float(os.environ.get('UPLOAD_GC_INTERVAL', 0))
+
+
+@app.before_request
+def start_job_workers():
+    if job_queue.ensure_started() and UPLOAD_GC_INTERVAL > 0:
+        with get_db_connection() as conn:
+            schedule_upload_gc(conn)
+            conn.commit()
+
+
+def schedule_upload_gc(conn) -> None:
+    if not job_queue.is_scheduled(conn, 'gc_uploads'):
+        job_queue.enqueue(conn, 'gc_uploads', {}, delay=UPLOAD_GC_INTERVAL)
+
+
+@job_queue.handler('gc_uploads')
+def gc_uploads_job(conn, payload):
+    report = uploads.collect_garbage(
+        conn, app.config['UPLOAD_FOLDER'], UPLOAD_GC_GRACE, dry_run=False, incoming=app.config['INCOMING_FOLDER'],
+    )
+    app.logger.info('Upload GC: %s', report)
+    schedule_upload_gc(conn)
+
+
+def migrate_uploads(conn) -> dict:
+    """Bring uploads stored before the current layout up to date, batch by batch."""
+    folder = app.config['UPLOAD_FOLDER']
+    report = uploads.register_legacy_uploads(conn, folder)
+    report.update(uploads.shard_uploads(conn, folder))
+    report['described'] = images.backfill_image_meta(conn, folder)
+    return report
+
+
+@job_queue.handler('migrate_uploads')
+def migrate_uploads_job(conn, payload):
+    app.logger.info('Upload migration: %s', migrate_uploads(conn))
+
+
+def strip_upload(path: str) -> bool:
+    """Strip EXIF/XMP from an upload's temp file in place; True if it changed.
+
+    Runs before the file is stored, so no blob ever published under a
+    content-addressed URL still carries location or camera metadata.
+    """
+    tmp_path = uploads.new_temp_path(app.config['INCOMING_FOLDER'])
+    try:
+        stripped = strip_metadata(path, tmp_path)
+    except Exception:
+        os.remove(tmp_path)
+        raise UnsupportedMediaType('The image could not be read.') from None
+    if stripped:
+        os.replace(tmp_path, path)
+    else:
+        os.remove(tmp_path)
+    return stripped
+
+
+# Uploads are stripped before they are stored; this only finishes jobs
+# queued before that, for blobs that were published unstripped
+@job_queue.handler('strip_metadata')
+def strip_metadata_job(conn, payload):
+    folder = app.config['UPLOAD_FOLDER']
+    source = payload['source']
+    tmp_path = uploads.new_temp_path(app.config['INCOMING_FOLDER'])
+    if strip_metadata(os.path.join(folder, source), tmp_path):
+        # Stored blobs never change, so posts move to the stripped copy
+        stripped = uploads.ingest_file(conn, folder, tmp_path, os.path.splitext(source)[1])
+        store_image_meta(conn, folder, stripped, placeholder=False)
+        conn.execute('UPDATE posts SET image = ? WHERE image = ?', (stripped, source))
+        # Stop serving the unstripped original as soon as no post uses it
+        uploads.delete_if_unreferenced(conn, folder, source)
+        source = stripped
+    else:
+        os.remove(tmp_path)
+    job_queue.enqueue(conn, 'image_variants', {'source': source})
+
+
+@job_queue.handler('image_variants')
+def image_variants_job(conn, payload):
+    folder = app.config['UPLOAD_FOLDER']
+    described = store_image_meta(conn, folder, payload['source'])
+    if generate_variants(conn, folder, payload['source']) or described:
+        # New markup for these posts: move their ETags and cache keys on
+        conn.execute(
+            "UPDATE posts SET revision = revision + 1, updated_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE image = ?",
+            (payload['source'],),
+        )
+
+
+def schedule_rebalance(conn, sort_key: str) -> None:
+    """Queue a key rewrite once a newly written key has grown long."""
+    if roadmap.needs_rebalance(sort_key) and not job_queue.is_scheduled(conn, 'rebalance_resources'):
+        job_queue.enqueue(conn, 'rebalance_resources', {})
+
+
+@job_queue.handler('rebalance_resources')
+def rebalance_resources_job(conn, payload):
+    for branch in roadmap.branches_to_rebalance(conn):
+        roadmap.rebalance(conn, branch)
+
+
+def enqueue_upload_processing(conn, image_filename) -> None:
+    if image_filename:
+        job_queue.enqueue(conn, 'image_variants', {'source': image_filename})
+
+
+@app.teardown_appcontext
+def release_db_connection(exc):
+    connection = g.pop('db', None)
+    if connection is not None:
+        db_pool.release(connection)
 
 
 def allowed_file(filename: str) -> bool:
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def save_image_upload(conn, file):
+    """Store an uploaded image by content hash; returns its name or None.
+
+    Dimensions are read from the header right away so the first page
+    showing the image can reserve its space; the blurred placeholder needs
+    a decode and is left to the image_variants job.
+    """
+    if not (file and file.filename and allowed_file(file.filename)):
+        return None
+    # UploadRequest streamed it to disk, hashed and sniffed it; the stored
+    # extension follows the content, never the client's filename
+    name = file.stream.ingest(conn, prepare=strip_upload)
+    store_image_meta(conn, app.config['UPLOAD_FOLDER'], name, placeholder=False)
+    return name
+
+
+def chunked_image_upload(conn):
+    """Name of an image finished through /api/uploads and named by the form, or None."""
+    name = request.form.get('uploaded_image', '').strip()
+    if not name:
+        return None
+    row = conn.execute('SELECT name FROM uploads WHERE name = ?', (name,)).fetchone()
+    return row['name'] if row else None
+
+
+@app.errorhandler(RequestEntityTooLarge)
+@app.errorhandler(UnsupportedMediaType)
+def upload_rejected(error):
+    # Admin forms get the reason back on the page they were submitted from
+    if request.endpoint == 'add_post':
+        flash(error.description, 'error')
+        return redirect(url_for('admin_dashboard'))
+    if request.endpoint == 'edit_post':
+        flash(error.description, 'error')
+        return redirect(url_for('edit_post', post_id=request.view_args['post_id']))
+    return error
+
+
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'replace-this-in-production')
 
 
+ASSETS_FOLDER = os.path.join(os.path.dirname(__file__), 'assets')
+
+# Content-hashed URLs for static/ and assets/, see asset_url() in templates.
+# 'flask build-assets' writes the manifest so workers skip hashing at boot.
+ASSET_MANIFEST_PATH = os.path.join(os.path.dirname(__file__), 'asset-manifest.json')
+# Stylesheets with their url()s rewritten to fingerprinted paths
+ASSET_BUILD_FOLDER = os.path.join(os.path.dirname(__file__), 'asset-build')
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+asset_manifest = AssetManifest({'': app.static_folder, 'assets/': ASSETS_FOLDER}, build_dir=ASSET_BUILD_FOLDER)
+if not asset_manifest.load(ASSET_MANIFEST_PATH):
+    asset_manifest.build()
+app.jinja_env.globals['asset_url'] = asset_manifest.url
+
+
+# Let the front server stream files when it supports X-Sendfile
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+
+
+def send_asset(directory: str, filename: str, max_age=None):
+    """send_from_directory, preferring a precompressed .br/.gz sibling."""
+    picked = pick_encoding(directory, filename, request.accept_encodings)
+    if picked is None:
+        response = send_from_directory(directory, filename, max_age=max_age)
+    else:
+        encoding, variant = picked
+        response = send_from_directory(
+            directory, variant, max_age=max_age,
+            mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+        )
+        response.headers['Content-Encoding'] = encoding
+    if is_compressible(filename):
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+def serve_static(filename: str):
+    # Hidden files and directories (old upload staging, editor and VCS
+    # leftovers) are never part of the site
+    if any(part.startswith('.') for part in filename.split('/')):
+        abort(404)
+    return send_asset(app.static_folder, filename, max_age=app.get_send_file_max_age(filename))
+
+
+app.view_functions['static'] = serve_static
+
+
 # Serve assets directory at 
 
 @app.route('/assets/<path:filename>')
 def serve_assets(filename: str):
-    assets_path = os.path.join(os.path.dirname(__file__), 'assets')
-    return send_from_directory(assets_path, filename)
+    return send_asset(ASSETS_FOLDER, filename)
+
+
+@app.route('/fp/<string:digest>/<path:filename>')
+def serve_fingerprinted(digest: str, filename: str):
+    current = asset_manifest.entries.get(filename)
+    if current is None:
+        abort(404)
+    if digest != current:
+        return redirect(asset_manifest.url(filename))
+    directory, name = asset_manifest.resolve(filename)
+    response = send_asset(directory, name, max_age=IMMUTABLE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+# /img/<name> renders uploads at a requested width on first use and keeps
+# the result in a size-bounded disk cache shared by all workers.
+IMAGE_CACHE_FOLDER = os.environ.get('IMAGE_CACHE_DIR', os.path.join(os.path.dirname(__file__), 'image-cache'))
+image_cache = DiskLRUCache(IMAGE_CACHE_FOLDER, int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 512 * 1024 * 1024)))
+# Requested widths snap up to one of these so the cache stays small
+IMAGE_WIDTHS = (160, 320, 480, 640, 800, 1200, 1600, 2000)
+IMAGE_FORMATS = ('avif', 'webp', 'jpeg', 'png')
+
+
+def image_url(name: str, width: int, quality=None, fmt=None) -> str:
+    return url_for('resized_image', name=name, w=width, q=quality, fmt=fmt)
+
+
+def image_srcset(name: str, max_width: int = IMAGE_WIDTHS[-1]) -> str:
+    return ', '.join(f'{image_url(name, w)} {w}w' for w in IMAGE_WIDTHS if w <= max_width)
+
+
+app.jinja_env.globals['image_url'] = image_url
+app.jinja_env.globals['upload_url'] = uploads.upload_url
+app.jinja_env.globals['image_srcset'] = image_srcset
+
+
+def snap_width(requested) -> int:
+    if requested is None or requested <= 0:
+        return IMAGE_WIDTHS[-1]
+    return next((w for w in IMAGE_WIDTHS if w >= requested), IMAGE_WIDTHS[-1])
+
+
+def negotiate_image_format(source: str) -> str:
+    # Only explicit Accept entries count: */* does not mean AVIF decodes
+    offered = {value for value, quality in request.accept_mimetypes if quality > 0}
+    for fmt in ('avif', 'webp'):
+        if images.FORMAT_MIMETYPES[fmt] in offered and images.can_encode(fmt):
+            return fmt
+    return 'png' if source.lower().endswith(('.png', '.gif')) else 'jpeg'
+
+
+@app.route('/img/<path:name>')
+def resized_image(name: str):
+    source = safe_join(app.config['UPLOAD_FOLDER'], name)
+    if source is None or name.startswith('.') or not allowed_file(name) or not os.path.isfile(source):
+        abort(404)
+    if not images.available():
+        return send_asset(app.config['UPLOAD_FOLDER'], name)
+    width = snap_width(request.args.get('w', type=int))
+    fmt = request.args.get('fmt', 'auto')
+    negotiated = fmt == 'auto'
+    if negotiated:
+        fmt = negotiate_image_format(name)
+    elif fmt not in IMAGE_FORMATS or not images.can_encode(fmt):
+        abort(400)
+    quality = request.args.get('q', type=int)
+    if fmt == 'png':
+        quality = None
+    elif quality is not None:
+        # Round so near-identical requests share one cache entry
+        quality = min(95, max(30, 5 * round(quality / 5)))
+
+    # Blob names are content hashes, so a rendition never goes stale
+    stem = name.replace('/', '_').rsplit('.', 1)[0]
+    key = f"{stem}-{width}w-q{quality or 0}{images.FORMAT_EXTENSIONS[fmt]}"
+    path = image_cache.get(key)
+    if path is None:
+        try:
+            if images.is_animated(source):
+                return send_asset(app.config['UPLOAD_FOLDER'], name)
+            path = image_cache.put(key, lambda tmp: images.render_resized(source, tmp, width, fmt, quality))
+        except (OSError, images.Image.DecompressionBombError):
+            app.logger.exception('Could not resize %s', name)
+            return send_asset(app.config['UPLOAD_FOLDER'], name)
+
+    response = send_file(path, mimetype=images.FORMAT_MIMETYPES[fmt], max_age=IMMUTABLE_MAX_AGE, etag=key)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    if negotiated:
+        response.vary.add('Accept')
+    return response
 
 
 def is_admin_logged_in() -> bool:
@@ -89,56 +424,401 @@ def require_admin():
     return None
 
 
+def require_admin_api():
+    if not is_admin_logged_in():
+        abort(403)
+
+
 # Simple admin credential
 ADMIN_USERNAME = os.environ.get('ADMIN_USERNAME', 'admin')
 ADMIN_PASSWORD_HASH = os.environ.get(
     'ADMIN_PASSWORD_HASH',
     generate_password_hash(os.environ.get('ADMIN_PASSWORD', 'changeme')),
 )
-def remove_welcome_if_exists(conn) -> None:
-    """Remove any auto-created 'Welcome' root resource if present."""
-    conn.execute("DELETE FROM resources WHERE LOWER(title) = 'welcome'")
-    conn.commit()
+
+
+# Keyset pagination for post listings
+POSTS_PER_PAGE = int(os.environ.get('POSTS_PER_PAGE', 10))
+MAX_POSTS_PER_PAGE = 50
+
+
+def fetch_posts_page(conn, before=None, limit=POSTS_PER_PAGE):
+    """Return one page of posts newest first, plus the cursor for the next page.
+
+    Pages are keyed on id (``WHERE id < before``) so every page is an index
+    range scan no matter how deep into the archive it is.
+    """
+    if before is None:
+        rows = conn.execute(
+            'SELECT id, title, excerpt, reading_time, date, image FROM posts ORDER BY id DESC LIMIT ?', (limit + 1,)
+        ).fetchall()
+    else:
+        rows = conn.execute(
+            'SELECT id, title, excerpt, reading_time, date, image FROM posts WHERE id < ? ORDER BY id DESC LIMIT ?',
+            (before, limit + 1),
+        ).fetchall()
+    posts = [dict(row) for row in rows[:limit]]
+    attach_variants(conn, posts)
+    next_cursor = posts[-1]['id'] if len(rows) > limit else None
+    return posts, next_cursor
+
+
+def page_limit() -> int:
+    limit = request.args.get('limit', POSTS_PER_PAGE, type=int)
+    return max(1, min(limit, MAX_POSTS_PER_PAGE))
+
+
+# Rendered public pages, dropped by the admin routes that change them
+page_cache = PageCache(
+    max_entries=int(os.environ.get('PAGE_CACHE_MAX_ENTRIES', 256)),
+    max_bytes=int(os.environ.get('PAGE_CACHE_MAX_BYTES', 32 * 1024 * 1024)),
+)
+POST_PAGES = ('index', 'api_posts', 'blog_detail', 'tag_page')
+RESOURCE_PAGES = ('resources_page', 'api_roadmap')
+# Roadmap layouts and SVG paths, computed once per resources version
+roadmap_layouts = roadmap.LayoutCache()
+# Above this many checkpoints /resources renders them on demand. Clients ask
+# /api/roadmap for chunk-aligned ranges, so the responses cache well.
+ROADMAP_WINDOW_THRESHOLD = int(os.environ.get('ROADMAP_WINDOW_THRESHOLD', 150))
+ROADMAP_WINDOW_CHUNK = 10 * roadmap.STEP_X
+ROADMAP_MAX_SPAN = 10 * ROADMAP_WINDOW_CHUNK
+
+
+def cached_page(view):
+    """Serve a GET view from page_cache, keyed by endpoint, URL args and query.
+
+    Under @conditional the key also carries the page's ETag, so a write made
+    by another worker process changes the key rather than serving stale HTML.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = (
+            request.endpoint,
+            tuple(sorted(request.view_args.items())),
+            tuple(sorted(request.args.items(multi=True))),
+            g.get('page_etag'),
+        )
+        hit = page_cache.get(key)
+        if hit is not None:
+            body, mimetype = hit
+            return app.response_class(body, mimetype=mimetype)
+        response = make_response(view(*args, **kwargs))
+        if response.status_code == 200 and not response.direct_passthrough:
+            page_cache.set(key, response.get_data(), response.mimetype)
+        return response
+    return wrapper
+
+
+def template_version() -> str:
+    digest = hashlib.sha256()
+    template_dir = os.path.join(os.path.dirname(__file__), 'templates')
+    for name in sorted(os.listdir(template_dir)):
+        with open(os.path.join(template_dir, name), 'rb') as fh:
+            digest.update(fh.read())
+    return digest.hexdigest()[:8]
+
+
+# Changes to any template or fingerprinted asset change every ETag
+TEMPLATE_VERSION = f'{template_version()}{asset_manifest.version}'
+
+
+def scope_validators(conn, scope: str):
+    row = conn.execute('SELECT revision, updated_at FROM content_revisions WHERE scope = ?', (scope,)).fetchone()
+    return f"{scope}-{row['revision']}-{TEMPLATE_VERSION}", row['updated_at']
+
+
+def post_validators(conn, post_id: int):
+    row = conn.execute('SELECT revision, updated_at FROM posts WHERE id = ?', (post_id,)).fetchone()
+    if row is None:
+        return None
+    return f"post-{post_id}-{row['revision']}-{TEMPLATE_VERSION}", row['updated_at']
+
+
+def conditional(validators):
+    """Answer GETs with ETag/Last-Modified and 304 when the client is current.
+
+    validators(conn, **view_args) returns (etag, updated_at epoch seconds),
+    or None to skip validation. The check runs before the view, so a 304
+    never touches the page cache or Jinja.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            with get_db_connection() as conn:
+                current = validators(conn, **kwargs)
+            if current is None:
+                return view(*args, **kwargs)
+            etag, updated_at = current
+            last_modified = datetime.fromtimestamp(updated_at or 0, tz=timezone.utc)
+            g.page_etag = etag
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains(etag)
+            else:
+                not_modified = request.if_modified_since is not None and last_modified <= request.if_modified_since
+            if not_modified:
+                response = app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
 
 
 def fetch_resources(conn):
     rows = conn.execute(
-        'SELECT id, title, url, order_index, branch, parent_id FROM resources ORDER BY branch ASC, order_index ASC'
+        'SELECT id, title, url, sort_key, branch, parent_id FROM resources ORDER BY branch ASC, sort_key ASC, id ASC'
     ).fetchall()
     return [dict(r) for r in rows]
 
 
-# Initialize DB at import time for environments without before_first_request
-init_db()
-# Clean up any legacy 'Welcome' entries
-with get_db_connection() as _conn:
-    remove_welcome_if_exists(_conn)
+def fetch_roadmap_layout(conn, branch=None) -> dict:
+    """Layout of the whole roadmap, or of one branch's subtree, from roadmap_layouts."""
+    def build():
+        resources = roadmap.fetch_subtree(conn, branch) if branch else fetch_resources(conn)
+        return roadmap.layout(resources)
+    return roadmap_layouts.get((branch, roadmap.resources_version(conn)), build)
+
+
+# Migrate at import time for environments without before_first_request;
+# a no-op single read once the schema is at head.
+with app.app_context():
+    init_db()
+# Leave nothing open for a preloading server to fork into its workers
+db_pool.close()
+
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Apply pending schema migrations."""
+    applied = init_db()
+    with get_db_connection() as conn:
+        version = migrations.current_version(conn)
+    if applied:
+        print(f"Applied migrations {', '.join(map(str, applied))}; schema at version {version}")
+    else:
+        print(f"Schema already at version {version}")
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Hash static/ and assets/ into the asset manifest, then precompress them."""
+    # Building first writes the rewritten stylesheets that get precompressed too
+    entries = asset_manifest.build()
+    totals = precompress([app.static_folder, ASSETS_FOLDER, ASSET_BUILD_FOLDER])
+    print(
+        f"Precompressed {totals['files']} files: {totals['original']} bytes -> "
+        f"gzip {totals['gzip']}, br {totals['br'] or 'n/a'}"
+    )
+    asset_manifest.save(ASSET_MANIFEST_PATH)
+    print(f"Wrote {len(entries)} entries to {ASSET_MANIFEST_PATH}")
+
+
+@app.cli.group('jobs')
+def jobs_cli():
+    """Inspect and run background jobs."""
+
+
+@jobs_cli.command('run')
+def jobs_run_command():
+    """Run every ready job in this process and exit."""
+    ran = job_queue.run_pending()
+    print(f"Ran {ran} jobs")
+
+
+@jobs_cli.command('prune')
+def jobs_prune_command():
+    """Delete finished jobs older than the retention period."""
+    with get_db_connection() as conn:
+        pruned = job_queue.prune(conn)
+        conn.commit()
+    print(f"Pruned {pruned} finished jobs")
+
+
+@jobs_cli.command('status')
+def jobs_status_command():
+    """Print job counts by status."""
+    with get_db_connection() as conn:
+        by_status = job_queue.stats(conn)['by_status']
+    for status, count in sorted(by_status.items()):
+        print(f"{status}: {count}")
+
+
+@app.cli.command('gc-uploads')
+@click.option('--delete', is_flag=True, help='Delete orphans instead of only reporting them.')
+@click.option('--grace-hours', type=float, default=UPLOAD_GC_GRACE / 3600, show_default=True,
+              help='Ignore files modified more recently than this.')
+def gc_uploads_command(delete: bool, grace_hours: float):
+    """Report or delete uploads that no post references."""
+    with get_db_connection() as conn:
+        report = uploads.collect_garbage(
+            conn, app.config['UPLOAD_FOLDER'], grace_hours * 3600, dry_run=not delete, incoming=app.config['INCOMING_FOLDER'],
+        )
+    print(f"Scanned {report['scanned']} files: {report['orphans']} orphans, "
+          f"{report['reclaimable_bytes']} bytes reclaimable")
+    if delete:
+        print(f"Deleted {report['deleted']} files")
+    else:
+        print('Dry run; pass --delete to remove them')
+
+
+@app.cli.command('migrate-uploads')
+def migrate_uploads_command():
+    """Register and relocate uploads left from older storage layouts; safe to re-run."""
+    with get_db_connection() as conn:
+        report = migrate_uploads(conn)
+    print(', '.join(f'{key}: {value}' for key, value in report.items()))
+
+
+@app.cli.command('backfill-images')
+@click.option('--workers', type=int, default=None, help='Worker processes (default: available cores).')
+def backfill_images_command(workers):
+    """Render responsive variants for existing uploads and asset images."""
+    if not images.available():
+        print('Pillow is not installed; nothing to do')
+        return
+
+    def progress(done, total):
+        if done % 25 == 0 or done == total:
+            print(f"  {done}/{total}")
+
+    with get_db_connection() as conn:
+        described = images.backfill_image_meta(conn, app.config['UPLOAD_FOLDER'])
+        print(f"Stored dimensions and placeholders for {described} uploads")
+        for folder, prefix in ((app.config['UPLOAD_FOLDER'], ''), (ASSETS_FOLDER, 'assets/')):
+            print(f"{folder}:")
+            report = backfill_variants(conn, folder, prefix, workers=workers, progress=progress)
+            rate = report['rendered'] / report['seconds'] if report['seconds'] else 0.0
+            print(
+                f"  rendered {report['rendered']}, skipped {report['skipped']}, failed {report['failed']} "
+                f"of {report['scanned']} in {report['seconds']:.1f}s ({rate:.2f} images/sec)"
+            )
+            if not report['sources']:
+                continue
+            # Pages showing these images get new markup
+            if prefix:
+                conn.execute(
+                    "UPDATE content_revisions SET revision = revision + 1, "
+                    "updated_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE scope = 'resources'"
+                )
+            else:
+                conn.executemany(
+                    "UPDATE posts SET revision = revision + 1, updated_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE image = ?",
+                    [(source,) for source in report['sources']],
+                )
+            conn.commit()
+    print("Run 'flask build-assets' to fingerprint new asset variants")
+
+
+@app.cli.command('backfill-excerpts')
+@click.option('--all', 'recompute_all', is_flag=True, help='Recompute every post, not just missing ones.')
+def backfill_excerpts_command(recompute_all: bool):
+    """Store excerpt, word count and reading time for existing posts."""
+    with get_db_connection() as conn:
+        updated = backfill_summaries(conn, only_missing=not recompute_all)
+    print(f"Updated {updated} posts")
+
+
+@app.cli.command('search-index')
+@click.argument('action', type=click.Choice(['rebuild', 'optimize']))
+def search_index_command(action: str):
+    """Rebuild or optimize the full-text search index."""
+    with get_db_connection() as conn:
+        if action == 'rebuild':
+            count = rebuild_index(conn)
+            print(f"Indexed {count} posts")
+        else:
+            optimize_index(conn)
+            print("Search index optimized")
 
 
 
 @app.route('/')
 @app.route('/index.html')
+@conditional(lambda conn: scope_validators(conn, 'posts'))
+@cached_page
 def index():
+    before = request.args.get('before', type=int)
     with get_db_connection() as conn:
-        rows = conn.execute(
-            'SELECT id, title, content, date, image FROM posts ORDER BY id DESC'
-        ).fetchall()
-    posts = [dict(row) for row in rows]
-    return render_template('index.html', posts=posts)
+        posts, next_cursor = fetch_posts_page(conn, before)
+    return render_template('index.html', posts=posts, next_cursor=next_cursor)
+
+
+@app.route('/api/posts')
+@conditional(lambda conn: scope_validators(conn, 'posts'))
+@cached_page
+def api_posts():
+    before = request.args.get('before', type=int)
+    with get_db_connection() as conn:
+        posts, next_cursor = fetch_posts_page(conn, before, page_limit())
+    return jsonify({
+        'posts': [
+            {'id': p['id'], 'title': p['title'], 'date': p['date'], 'image': p['image'],
+             'url': url_for('blog_detail', post_id=p['id'])}
+            for p in posts
+        ],
+        'html': render_template('_blog_cards.html', posts=posts),
+        'next_cursor': next_cursor,
+    })
 
 
 @app.route('/blogs/<int:post_id>')
+@conditional(post_validators)
+@cached_page
 def blog_detail(post_id: int):
     with get_db_connection() as conn:
         row = conn.execute(
-            'SELECT id, title, content, date, image FROM posts WHERE id = ?', (post_id,)
+            'SELECT id, title, content, date, image, reading_time FROM posts WHERE id = ?', (post_id,)
         ).fetchone()
-    if row is None:
-        abort(404)
-    post = dict(row)
+        if row is None:
+            abort(404)
+        post = dict(row)
+        post['tags'] = fetch_post_tags(conn, post_id)
+        attach_variants(conn, [post])
     return render_template('blogs.html', post=post)
 
 
+@app.route('/tags/<string:slug>')
+@conditional(lambda conn, slug: scope_validators(conn, 'posts'))
+@cached_page
+def tag_page(slug: str):
+    before = request.args.get('before', type=int)
+    with get_db_connection() as conn:
+        tag = fetch_tag(conn, slug)
+        if tag is None:
+            abort(404)
+        posts, next_cursor = fetch_tag_posts_page(conn, tag['id'], before, page_limit())
+    return render_template('tag.html', tag=tag, posts=posts, next_cursor=next_cursor)
+
+
+@app.route('/search')
+def search_page():
+    q = request.args.get('q', '').strip()
+    with get_db_connection() as conn:
+        results, next_cursor = search_posts(conn, q, request.args.get('after'), page_limit())
+    return render_template('search.html', q=q, results=results, next_cursor=next_cursor)
+
+
+@app.route('/api/search')
+def api_search():
+    q = request.args.get('q', '').strip()
+    with get_db_connection() as conn:
+        results, next_cursor = search_posts(conn, q, request.args.get('after'), page_limit())
+    return jsonify({
+        'results': [
+            {'id': r['id'], 'title': r['title'], 'date': r['date'], 'image': r['image'],
+             'snippet': str(r['snippet']), 'score': r['score'],
+             'url': url_for('blog_detail', post_id=r['id'])}
+            for r in results
+        ],
+        'next_cursor': next_cursor,
+    })
+
+
 @app.route('/admin-login', methods=['GET', 'POST'])
 def admin_login():
     if request.method == 'POST':
@@ -159,11 +839,16 @@ def admin_dashboard():
         return redirect_if_needed
 
     with get_db_connection() as conn:
-        rows = conn.execute('SELECT id, title, content, date, image FROM posts ORDER BY id DESC').fetchall()
+        rows = conn.execute('SELECT id, title, date, image FROM posts ORDER BY id DESC').fetchall()
         resources = fetch_resources(conn)
-    posts = [dict(row) for row in rows]
+        resources_version = roadmap.resources_version(conn)
+        posts = [dict(row) for row in rows]
+        attach_variants(conn, posts)
 
-    return render_template('admin.html', posts=posts, edit_post=None, resources=resources)
+    return render_template(
+        'admin.html', posts=posts, edit_post=None, resources=resources, resources_version=resources_version,
+        resource_titles={r['id']: r['title'] for r in resources},
+    )
 
 
 @app.route('/logout')
@@ -180,11 +865,7 @@ def add_post():
 
     title = request.form.get('title', '').strip()
     content = request.form.get('content', '').strip()
-    tags = request.form.get('tags', '').strip()
-
-    # Append tags to content for now to keep DB schema as requested
-    if tags:
-        content = f"{content}\n\nTags: {tags}"
+    tags = split_tags(request.form.get('tags', ''))
 
     date_str = datetime.now().strftime('%Y-%m-%d %H:%M')
 
@@ -192,23 +873,18 @@ def add_post():
         flash('Title and content are required', 'error')
         return redirect(url_for('admin_dashboard'))
 
-    image_filename = None
-    file = request.files.get('image')
-    if file and file.filename and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        # Make filename unique
-        name, ext = os.path.splitext(filename)
-        unique_name = f"{name}_{int(datetime.now().timestamp())}{ext}"
-        save_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_name)
-        file.save(save_path)
-        image_filename = unique_name
-
     with get_db_connection() as conn:
-        conn.execute(
-            'INSERT INTO posts (title, content, date, image) VALUES (?, ?, ?, ?)',
-            (title, content, date_str, image_filename),
+        image_filename = save_image_upload(conn, request.files.get('image')) or chunked_image_upload(conn)
+        summary = summarize(content)
+        cur = conn.execute(
+            'INSERT INTO posts (title, content, date, image, excerpt, word_count, reading_time) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (title, content, date_str, image_filename, summary['excerpt'], summary['word_count'], summary['reading_time']),
         )
+        set_post_tags(conn, cur.lastrowid, tags)
+        enqueue_upload_processing(conn, image_filename)
         conn.commit()
+        page_cache.invalidate(*POST_PAGES)
+    job_queue.notify()
 
     return redirect(url_for('admin_dashboard'))
 
@@ -221,49 +897,46 @@ def edit_post(post_id: int):
 
     with get_db_connection() as conn:
         row = conn.execute('SELECT id, title, content, date, image FROM posts WHERE id = ?', (post_id,)).fetchone()
-    if row is None:
-        abort(404)
-    post = dict(row)
+        if row is None:
+            abort(404)
+        post = dict(row)
+        post['tags'] = ', '.join(t['name'] for t in fetch_post_tags(conn, post_id))
 
     if request.method == 'POST':
         title = request.form.get('title', '').strip()
         content = request.form.get('content', '').strip()
-        tags = request.form.get('tags', '').strip()
-
-        if tags:
-            # Replace or append tags: remove existing Tags: line if present, then add new
-            content_lines = [line for line in content.splitlines() if not line.startswith('Tags:')]
-            content = '\n'.join(content_lines)
-            content = f"{content}\n\nTags: {tags}"
+        tags = split_tags(request.form.get('tags', ''))
 
         if not title or not content:
             flash('Title and content are required', 'error')
             return redirect(url_for('edit_post', post_id=post_id))
 
-        # Handle optional new image
-        image_filename = post.get('image')
-        file = request.files.get('image')
-        if file and file.filename and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            name, ext = os.path.splitext(filename)
-            unique_name = f"{name}_{int(datetime.now().timestamp())}{ext}"
-            save_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_name)
-            file.save(save_path)
-            image_filename = unique_name
-
         with get_db_connection() as conn:
+            # Handle optional new image; without one the stored image is left
+            # alone, so a job that swapped it meanwhile is not undone
+            image_filename = save_image_upload(conn, request.files.get('image')) or chunked_image_upload(conn)
+            summary = summarize(content)
             conn.execute(
-                'UPDATE posts SET title = ?, content = ?, image = ? WHERE id = ?',
-                (title, content, image_filename, post_id),
+                """
+                UPDATE posts SET title = ?, content = ?, image = COALESCE(?, image), excerpt = ?, word_count = ?, reading_time = ?
+                WHERE id = ?
+                """,
+                (title, content, image_filename, summary['excerpt'], summary['word_count'], summary['reading_time'], post_id),
             )
+            set_post_tags(conn, post_id, tags)
+            if image_filename and image_filename != post.get('image'):
+                enqueue_upload_processing(conn, image_filename)
             conn.commit()
+            page_cache.invalidate(*POST_PAGES)
+        job_queue.notify()
 
         return redirect(url_for('admin_dashboard'))
 
     # GET: render admin dashboard with edit form populated
     with get_db_connection() as conn:
-        rows = conn.execute('SELECT id, title, content, date, image FROM posts ORDER BY id DESC').fetchall()
-    posts = [dict(row) for row in rows]
+        rows = conn.execute('SELECT id, title, date, image FROM posts ORDER BY id DESC').fetchall()
+        posts = [dict(row) for row in rows]
+        attach_variants(conn, posts)
     return render_template('admin.html', posts=posts, edit_post=post)
 
 
@@ -276,6 +949,7 @@ def delete_post(post_id: int):
     with get_db_connection() as conn:
         conn.execute('DELETE FROM posts WHERE id = ?', (post_id,))
         conn.commit()
+        page_cache.invalidate(*POST_PAGES)
     return redirect(url_for('admin_dashboard'))
 
 
@@ -287,20 +961,40 @@ def add_resource():
 
     title = request.form.get('res_title', '').strip()
     url_val = request.form.get('res_url', '').strip()
-    branch = 'main'
-    parent_id = None
+    branch = request.form.get('res_branch', '').strip()[:64] or 'main'
+    parent_id = request.form.get('res_parent', type=int)
     if not title or not url_val:
         flash('Resource title and URL are required', 'error')
         return redirect(url_for('admin_dashboard'))
 
     with get_db_connection() as conn:
-        
-        # Default non-main parent to root if not provided
-        max_order_row = conn.execute('SELECT COALESCE(MAX(order_index), -1) FROM resources WHERE branch = ?', (branch,)).fetchone()
-        max_order = max_order_row[0] if max_order_row is not None else -1
-        next_order = (max_order if max_order is not None else -1) + 1
-        conn.execute('INSERT INTO resources (title, url, order_index, branch, parent_id) VALUES (?, ?, ?, ?, ?)', (title, url_val, next_order, branch, parent_id))
-        conn.commit()
+        # The last key is read under the write lock, so concurrent appends
+        # to a branch never compute the same key
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            exists, branch_parent = roadmap.branch_parent(conn, branch)
+            if exists:
+                # A branch forks at one point; later resources just extend it
+                parent_id = branch_parent
+            elif parent_id is not None and not conn.execute(
+                'SELECT 1 FROM resources WHERE id = ?', (parent_id,)
+            ).fetchone():
+                conn.rollback()
+                flash('The resource to branch from no longer exists', 'error')
+                return redirect(url_for('admin_dashboard'))
+            sort_key = roadmap.append_key(conn, branch)
+            conn.execute(
+                'INSERT INTO resources (title, url, sort_key, branch, parent_id) VALUES (?, ?, ?, ?, ?)',
+                (title, url_val, sort_key, branch, parent_id),
+            )
+            schedule_rebalance(conn, sort_key)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        page_cache.invalidate(*RESOURCE_PAGES)
+        roadmap_layouts.clear()
+    job_queue.notify()
     return redirect(url_for('admin_dashboard'))
 
 
@@ -311,15 +1005,14 @@ def delete_resource(res_id: int):
         return redirect_if_needed
 
     with get_db_connection() as conn:
-        # Get order of the item to delete
-        row = conn.execute('SELECT order_index, branch FROM resources WHERE id = ?', (res_id,)).fetchone()
+        row = conn.execute('SELECT id, sort_key, branch, parent_id FROM resources WHERE id = ?', (res_id,)).fetchone()
         if row:
-            order_idx = row['order_index']
-            branch = row['branch']
+            roadmap.detach_forks(conn, row)
+            # Sparse keys leave the rest of the branch untouched
             conn.execute('DELETE FROM resources WHERE id = ?', (res_id,))
-            # Shift down items after this within the same branch
-            conn.execute('UPDATE resources SET order_index = order_index - 1 WHERE branch = ? AND order_index > ?', (branch, order_idx))
             conn.commit()
+            page_cache.invalidate(*RESOURCE_PAGES)
+            roadmap_layouts.clear()
     return redirect(url_for('admin_dashboard'))
 
 
@@ -333,84 +1026,208 @@ def move_resource(res_id: int, direction: str):
         abort(400)
 
     with get_db_connection() as conn:
-        row = conn.execute('SELECT id, order_index, branch FROM resources WHERE id = ?', (res_id,)).fetchone()
-        if not row:
-            abort(404)
-        current_order = row['order_index']
-        branch = row['branch']
-        swap_with = current_order - 1 if direction == 'up' else current_order + 1
+        # Neighbours are read under the write lock, as in add_resource()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT id, sort_key, branch FROM resources WHERE id = ?', (res_id,)).fetchone()
+            if not row:
+                abort(404)
+            sort_key = roadmap.neighbour_key(conn, row, direction)
+            if sort_key is None:
+                conn.rollback()
+                return redirect(url_for('admin_dashboard'))
+
+            conn.execute('UPDATE resources SET sort_key = ? WHERE id = ?', (sort_key, res_id))
+            schedule_rebalance(conn, sort_key)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        page_cache.invalidate(*RESOURCE_PAGES)
+        roadmap_layouts.clear()
+    job_queue.notify()
+
+    return redirect(url_for('admin_dashboard'))
 
-        other = conn.execute('SELECT id FROM resources WHERE branch = ? AND order_index = ?', (branch, swap_with)).fetchone()
-        if not other:
-            return redirect(url_for('admin_dashboard'))
 
-        other_id = other['id']
-        # Swap order_index values within the branch
-        conn.execute('UPDATE resources SET order_index = ? WHERE id = ?', (swap_with, res_id))
-        conn.execute('UPDATE resources SET order_index = ? WHERE id = ?', (current_order, other_id))
+@app.route('/api/resources/reorder', methods=['POST'])
+def reorder_resources():
+    """Apply a whole branch order, or one move, in a single transaction.
+
+    The body carries the resources version the client last saw, as
+    {"version": v, "branch": b, "order": [ids]} or
+    {"version": v, "move": {"id": id, "position": n}}. A stale version gets
+    409 and nothing changes; otherwise the reply has the new order and version.
+    """
+    require_admin_api()
+    payload = request.get_json(silent=True) or {}
+    version = payload.get('version')
+    with get_db_connection() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            current = roadmap.resources_version(conn)
+            if version != current:
+                conn.rollback()
+                return jsonify({'error': 'Resources changed; reload to see the latest order.', 'version': current}), 409
+            if 'order' in payload:
+                branch = payload.get('branch') or 'main'
+                ids = payload['order']
+                if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+                    abort(400)
+                try:
+                    moved = roadmap.reorder(conn, branch, ids)
+                except ValueError:
+                    abort(400)
+                if moved:
+                    schedule_rebalance(conn, max(moved, key=len))
+            elif isinstance(payload.get('move'), dict):
+                move = payload['move']
+                if not isinstance(move.get('id'), int) or not isinstance(move.get('position'), int):
+                    abort(400)
+                row = conn.execute('SELECT id, sort_key, branch FROM resources WHERE id = ?', (move['id'],)).fetchone()
+                if row is None:
+                    abort(404)
+                branch = row['branch']
+                schedule_rebalance(conn, roadmap.move_to(conn, row, move['position']))
+            else:
+                abort(400)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        order = roadmap.branch_ids(conn, branch)
+        version = roadmap.resources_version(conn)
+    page_cache.invalidate(*RESOURCE_PAGES)
+    roadmap_layouts.clear()
+    job_queue.notify()
+    return jsonify({'branch': branch, 'order': order, 'version': version})
+
+
+# Resumable uploads: the admin form sends large images here in chunks, so a
+# dropped connection resumes from the last chunk and each request is short.
+UPLOAD_CHUNK_BYTES = int(os.environ.get('UPLOAD_CHUNK_BYTES', 1024 * 1024))
+
+
+@app.route('/api/uploads', methods=['POST'])
+def create_upload():
+    require_admin_api()
+    payload = request.get_json(silent=True) or {}
+    if not allowed_file(str(payload.get('filename', ''))):
+        abort(415)
+    size = payload.get('size')
+    if not isinstance(size, int):
+        abort(400)
+    upload = uploads.ChunkedUpload.create(
+        app.config['UPLOAD_FOLDER'], app.config['INCOMING_FOLDER'], size, app.config['MAX_UPLOAD_BYTES'],
+    )
+    return jsonify(dict(upload.status(), chunk_size=UPLOAD_CHUNK_BYTES)), 201
+
+
+@app.route('/api/uploads/<string:upload_id>', methods=['GET'])
+def upload_status(upload_id: str):
+    require_admin_api()
+    upload = uploads.ChunkedUpload.load(app.config['UPLOAD_FOLDER'], app.config['INCOMING_FOLDER'], upload_id)
+    return jsonify(dict(upload.status(), chunk_size=UPLOAD_CHUNK_BYTES))
+
+
+@app.route('/api/uploads/<string:upload_id>', methods=['PUT'])
+def upload_chunk(upload_id: str):
+    require_admin_api()
+    upload = uploads.ChunkedUpload.load(app.config['UPLOAD_FOLDER'], app.config['INCOMING_FOLDER'], upload_id)
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        abort(400)
+    if request.content_length is None or request.content_length > UPLOAD_CHUNK_BYTES:
+        abort(413)
+    upload.write_chunk(offset, request.get_data(cache=False), request.headers.get('X-Chunk-Checksum'))
+    return jsonify(upload.status())
+
+
+@app.route('/api/uploads/<string:upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id: str):
+    require_admin_api()
+    upload = uploads.ChunkedUpload.load(app.config['UPLOAD_FOLDER'], app.config['INCOMING_FOLDER'], upload_id)
+    with get_db_connection() as conn:
+        name = upload.finalize(conn, prepare=strip_upload)
+        store_image_meta(conn, app.config['UPLOAD_FOLDER'], name, placeholder=False)
         conn.commit()
+    return jsonify({'name': name, 'url': uploads.upload_url(name)})
 
-    return redirect(url_for('admin_dashboard'))
+
+@app.route('/admin/stats')
+def admin_stats():
+    redirect_if_needed = require_admin()
+    if redirect_if_needed:
+        return redirect_if_needed
+    with get_db_connection() as conn:
+        jobs = job_queue.stats(conn)
+    return jsonify({
+        'db_pool': db_pool.stats(),
+        'page_cache': page_cache.stats(),
+        'image_cache': image_cache.stats(),
+        'roadmap_layouts': roadmap_layouts.stats(),
+        'jobs': jobs,
+    })
 
 
 @app.route('/about')
+@cached_page
 def about_page():
     return render_template('about.html')
 
 
 @app.route('/resources')
+@conditional(lambda conn: scope_validators(conn, 'resources'))
+@cached_page
 def resources_page():
+    branch = request.args.get('branch')
     with get_db_connection() as conn:
-        resources = fetch_resources(conn)
-
-    # Only main branch, linear sequence
-    main_items = [r for r in resources if (r.get('branch') or 'main') == 'main']
-    main_items = sorted(main_items, key=lambda x: x.get('order_index', 0))
-
-    step_x = 420
-    margin_x = 0
-    svg_height = 600
-
-    y_pct = 58
-    layout = []
-    for i, r in enumerate(main_items):
-        x = margin_x + i * step_x
-        layout.append({
-            'id': r['id'],
-            'title': r['title'],
-            'url': r['url'],
-            'order_index': r.get('order_index', i),
-            'x': x,
-            'y_pct': y_pct,
-        })
-
-    total_width = margin_x + (len(main_items) if main_items else 1) * step_x + 200
-
-    # Single path
-    def build_path():
-        y = int(svg_height * (y_pct / 100.0))
-        d = f"M 0 {y} "
-        segment = 300
-        x = 0
-        toggle = 1
-        while x < total_width - 50:
-            cx1 = x + segment // 2
-            cy1 = y - 50 * toggle
-            x2 = min(total_width - 50, x + segment)
-            cy2 = y + 50 * toggle
-            d += f"S {int(cx1)} {int(cy1)}, {int(x2)} {int(cy2)} "
-            x += segment
-            toggle *= -1
-        return d.strip()
-
-    branch_paths = [{ 'branch': 'main', 'd': build_path() }]
-
-    return render_template('resources.html', layout=layout, branch_paths=branch_paths, canvas_width=total_width, svg_height=svg_height)
+        roadmap_layout = fetch_roadmap_layout(conn, branch)
+        asset_sources = [row[0] for row in conn.execute(
+            "SELECT DISTINCT source FROM image_variants WHERE source LIKE 'assets/%'"
+        )]
+        asset_images = fetch_variants(conn, asset_sources, url=asset_manifest.url)
+
+    # Long roadmaps ship without checkpoints; script.js fetches the ones near
+    # the visible part of the track from /api/roadmap as it scrolls
+    windowed = len(roadmap_layout['nodes']) > ROADMAP_WINDOW_THRESHOLD
+    return render_template(
+        'resources.html', layout=[] if windowed else roadmap_layout['nodes'], branch_paths=roadmap_layout['tracks'],
+        canvas_width=roadmap_layout['width'], svg_height=roadmap_layout['height'], asset_images=asset_images,
+        windowed=windowed, node_count=len(roadmap_layout['nodes']), branch=branch,
+        last_x=max((t['x1'] for t in roadmap_layout['tracks']), default=0), window_chunk=ROADMAP_WINDOW_CHUNK,
+    )
+
+
+@app.route('/api/roadmap')
+@conditional(lambda conn: scope_validators(conn, 'resources'))
+@cached_page
+def api_roadmap():
+    """Layout nodes with x0 <= x < x1 (SVG units), optionally for one branch's subtree."""
+    branch = request.args.get('branch')
+    x0 = request.args.get('x0', 0, type=int)
+    x1 = request.args.get('x1', x0 + ROADMAP_WINDOW_CHUNK, type=int)
+    if x1 < x0:
+        abort(400)
+    x1 = min(x1, x0 + ROADMAP_MAX_SPAN)
+    with get_db_connection() as conn:
+        roadmap_layout = fetch_roadmap_layout(conn, branch)
+    return jsonify({
+        'x0': x0,
+        'x1': x1,
+        'width': roadmap_layout['width'],
+        'height': roadmap_layout['height'],
+        'nodes': [
+            {key: node[key] for key in ('id', 'title', 'url', 'branch', 'x', 'y_pct', 'after', 'order_index')}
+            for node in roadmap.nodes_between(roadmap_layout, x0, x1)
+        ],
+    })
 
 
 if __name__ == '__main__':
     # Ensure DB exists before running
-    init_db()
+    with app.app_context():
+        init_db()
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=True)
 
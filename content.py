@@ -0,0 +1,75 @@
+import math
+import re
+
+
+EXCERPT_LENGTH = 180
+WORDS_PER_MINUTE = 200
+
+
+def summarize(content: str) -> dict:
+    """Compute the listing fields stored alongside a post body."""
+    content = content or ''
+    excerpt = content[:EXCERPT_LENGTH]
+    if len(content) > EXCERPT_LENGTH:
+        excerpt += '...'
+    word_count = len(content.split())
+    return {
+        'excerpt': excerpt,
+        'word_count': word_count,
+        'reading_time': max(1, math.ceil(word_count / WORDS_PER_MINUTE)),
+    }
+
+
+def backfill_summaries(conn, only_missing: bool = True, batch_size: int = 500) -> int:
+    """Fill excerpt/word_count/reading_time for existing posts in id batches."""
+    updated = 0
+    last_id = 0
+    missing = ' AND excerpt IS NULL' if only_missing else ''
+    while True:
+        rows = conn.execute(
+            f'SELECT id, content FROM posts WHERE id > ?{missing} ORDER BY id LIMIT ?',
+            (last_id, batch_size),
+        ).fetchall()
+        if not rows:
+            break
+        conn.executemany(
+            'UPDATE posts SET excerpt = :excerpt, word_count = :word_count, reading_time = :reading_time WHERE id = :id',
+            [dict(summarize(row['content']), id=row['id']) for row in rows],
+        )
+        updated += len(rows)
+        last_id = rows[-1]['id']
+    return updated
+
+
+def slugify(name: str) -> str:
+    return '-'.join(re.findall(r'[^\W_]+', name.lower()))
+
+
+def split_tags(raw: str) -> list:
+    """Parse a comma separated tag field, dropping blanks and duplicates.
+
+    Space separated hashtags ("#web #xss") are accepted as separate tags.
+    """
+    parts = []
+    for part in (raw or '').split(','):
+        parts.extend(part.split() if '#' in part else [part])
+    names = []
+    seen = set()
+    for part in parts:
+        name = ' '.join(part.split()).lstrip('#')
+        slug = slugify(name)
+        if slug and slug not in seen:
+            seen.add(slug)
+            names.append(name)
+    return names
+
+
+def strip_legacy_tags(content: str):
+    """Split a body that still carries a 'Tags: ...' line into (body, raw tags)."""
+    lines = (content or '').splitlines()
+    tag_lines = [line for line in lines if line.startswith('Tags:')]
+    if not tag_lines:
+        return content, ''
+    body = '\n'.join(line for line in lines if not line.startswith('Tags:')).rstrip()
+    raw = ', '.join(line[len('Tags:'):].strip() for line in tag_lines)
+    return body, raw
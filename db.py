@@ -0,0 +1,114 @@
+import os
+import queue
+import sqlite3
+import threading
+
+
+# Applied to every new connection. journal_mode=WAL is persistent in the
+# database file, the rest are per-connection settings.
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -16000,
+    'mmap_size': 268435456,
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000,
+}
+
+
+class ConnectionPool:
+    """A small pool of reusable SQLite connections.
+
+    Connections are handed out one borrower at a time (a request or a
+    background thread) and returned with release(). Idle connections keep
+    their page cache warm between requests. SQLite connections must not
+    cross fork(), so a pool used in a new process starts over empty.
+    """
+
+    def __init__(self, path: str, max_idle: int = 8, pragmas=None):
+        self.path = path
+        self.max_idle = max_idle
+        self.pragmas = dict(DEFAULT_PRAGMAS)
+        if pragmas:
+            self.pragmas.update(pragmas)
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        # Connections inherited across fork(); kept referenced so they are
+        # never closed (or used) from the child
+        self._inherited = []
+        self._stats = {
+            'created': 0,
+            'reused': 0,
+            'released': 0,
+            'discarded': 0,
+            'in_use': 0,
+        }
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            if value is None:
+                continue
+            connection.execute(f'PRAGMA {name} = {value}')
+        return connection
+
+    def _check_pid(self) -> None:
+        if self._pid == os.getpid():
+            return
+        while True:
+            try:
+                self._inherited.append(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        with self._lock:
+            self._stats['in_use'] = 0
+
+    def acquire(self) -> sqlite3.Connection:
+        self._check_pid()
+        try:
+            connection = self._idle.get_nowait()
+            reused = True
+        except queue.Empty:
+            connection = self._connect()
+            reused = False
+        with self._lock:
+            self._stats['reused' if reused else 'created'] += 1
+            self._stats['in_use'] += 1
+        return connection
+
+    def release(self, connection: sqlite3.Connection) -> None:
+        if self._pid != os.getpid():
+            # Borrowed before a fork: never pool it in this process
+            self._check_pid()
+            self._inherited.append(connection)
+            return
+        # Never hand out a connection with a half-finished transaction.
+        if connection.in_transaction:
+            connection.rollback()
+        with self._lock:
+            self._stats['in_use'] -= 1
+            keep = self._idle.qsize() < self.max_idle
+            self._stats['released' if keep else 'discarded'] += 1
+        if keep:
+            self._idle.put(connection)
+        else:
+            connection.close()
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats['idle'] = self._idle.qsize()
+        stats['max_idle'] = self.max_idle
+        stats['pragmas'] = dict(self.pragmas)
+        return stats
@@ -0,0 +1,107 @@
+import os
+import tempfile
+import threading
+
+
+class DiskLRUCache:
+    """Size-bounded directory of rendered files, evicted least recently used first.
+
+    Recency is the file mtime, refreshed on every hit, so worker processes
+    sharing the directory agree on it. Each process keeps a running byte
+    total and only rescans the directory once that total goes over
+    max_bytes; eviction then trims down to low_water * max_bytes so the
+    scans stay rare.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, low_water: float = 0.9):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._bytes = None
+        self._stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'evicted_bytes': 0}
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str):
+        """Return the path of a cached entry and mark it used, or None."""
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._stats['misses'] += 1
+            return None
+        with self._lock:
+            self._stats['hits'] += 1
+        return path
+
+    def put(self, key: str, write) -> str:
+        """Create an entry by calling write(tmp_path); returns its final path."""
+        path = self.path(key)
+        # Dot prefix keeps half-written files out of eviction scans
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.', suffix='.tmp')
+        os.close(fd)
+        try:
+            write(tmp_path)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self._lock:
+            self._stats['stores'] += 1
+            if self._bytes is None:
+                self._bytes = self._scan_total()
+            else:
+                self._bytes += size
+            if self._bytes > self.max_bytes:
+                self._evict(keep=key)
+        return path
+
+    def _entries(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.startswith('.') or not entry.is_file(follow_symlinks=False):
+                    continue
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.name))
+        return entries
+
+    def _scan_total(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self, keep: str) -> None:
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * self.low_water
+        for _, size, name in entries:
+            if total <= target:
+                break
+            if name == keep:
+                continue
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass  # another worker evicted it first
+            else:
+                self._stats['evictions'] += 1
+                self._stats['evicted_bytes'] += size
+            total -= size
+        self._bytes = total
+
+    def stats(self) -> dict:
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = self._scan_total()
+            stats = dict(self._stats)
+            stats['bytes'] = self._bytes
+        stats['max_bytes'] = self.max_bytes
+        return stats
@@ -0,0 +1,433 @@
+import base64
+import io
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+try:
+    from PIL import Image, ImageFilter, ImageOps, features
+except ImportError:  # Pillow is optional; originals are served as-is without it
+    Image = None
+
+import jobs
+from uploads import VARIANTS_DIRNAME, file_sha256, iter_files, upload_url
+
+
+# Width-bounded renditions of each upload; every width is written as WebP
+# and as a JPEG (or PNG, for images with transparency) fallback.
+VARIANT_WIDTHS = {'thumb': 320, 'card': 800, 'cover': 1600}
+WEBP_QUALITY = 80
+JPEG_QUALITY = 82
+AVIF_QUALITY = 60
+# Inline blurred preview shown until the real image arrives
+PLACEHOLDER_SIZE = 16
+PLACEHOLDER_QUALITY = 40
+
+logger = logging.getLogger(__name__)
+
+FORMAT_MIMETYPES = {'avif': 'image/avif', 'webp': 'image/webp', 'jpeg': 'image/jpeg', 'png': 'image/png'}
+FORMAT_EXTENSIONS = {'avif': '.avif', 'webp': '.webp', 'jpeg': '.jpg', 'png': '.png'}
+DEFAULT_QUALITY = {'avif': AVIF_QUALITY, 'webp': WEBP_QUALITY, 'jpeg': JPEG_QUALITY, 'png': None}
+
+
+def available() -> bool:
+    return Image is not None
+
+
+def can_encode(fmt: str) -> bool:
+    """Whether this Pillow build can write fmt ('avif' needs libavif)."""
+    if not available():
+        return False
+    if fmt in ('avif', 'webp'):
+        return features.check(fmt)
+    return fmt in FORMAT_EXTENSIONS
+
+
+def _has_alpha(img) -> bool:
+    return img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+
+
+def _encode(img, target, fmt: str, quality=None) -> None:
+    """Write img as fmt to target, a path or a binary file object."""
+    quality = quality or DEFAULT_QUALITY[fmt]
+    if fmt == 'avif':
+        img.save(target, 'AVIF', quality=quality)
+    elif fmt == 'webp':
+        img.save(target, 'WEBP', quality=quality, method=6)
+    elif fmt == 'jpeg':
+        img.convert('RGB').save(target, 'JPEG', quality=quality, optimize=True, progressive=True)
+    else:
+        img.save(target, 'PNG', optimize=True)
+
+
+def _save(img, path: str, fmt: str, quality=None) -> None:
+    # Unique temp name: two jobs may render the same shared blob at once.
+    # The dot keeps it out of the upload collector's scans.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            _encode(img, fh, fmt, quality)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def is_animated(path: str) -> bool:
+    with Image.open(path) as img:
+        return getattr(img, 'is_animated', False)
+
+
+def render_resized(src_path: str, dest_path: str, width: int, fmt: str, quality=None) -> None:
+    """Write src_path scaled to at most width pixels wide as fmt to dest_path.
+
+    dest_path is written in place, so callers pass a temp path they own
+    (DiskLRUCache.put() hands over its own).
+    """
+    with Image.open(src_path) as original:
+        img = ImageOps.exif_transpose(original)
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if _has_alpha(img) else 'RGB')
+        if width < img.width:
+            height = max(1, round(img.height * width / img.width))
+            img = img.resize((width, height), Image.LANCZOS)
+        with open(dest_path, 'wb') as fh:
+            _encode(img, fh, fmt, quality)
+
+
+def strip_metadata(path: str, dest_path: str) -> bool:
+    """Write a copy of an image without EXIF/XMP metadata to dest_path.
+
+    An upright JPEG is saved with its original quantization tables, so the
+    copy loses no quality. Only an EXIF orientation other than 1 means
+    rotating the pixels and encoding again. Returns False, writing nothing,
+    when there was no metadata to strip.
+    """
+    if not available():
+        return False
+    with Image.open(path) as img:
+        if getattr(img, 'is_animated', False):
+            return False
+        exif = img.getexif()
+        if not (exif or 'xmp' in img.info or 'XML:com.adobe.xmp' in img.info):
+            return False
+        fmt = img.format
+        icc_profile = img.info.get('icc_profile')
+        options = {'icc_profile': icc_profile} if icc_profile else {}
+        if exif.get(0x0112, 1) == 1:
+            out = img
+            if fmt == 'JPEG':
+                options.update(quality='keep', subsampling='keep')
+        else:
+            out = ImageOps.exif_transpose(img)
+            if fmt == 'JPEG':
+                options['quality'] = 90
+        if fmt == 'WEBP':
+            options['quality'] = 90
+        out.save(dest_path, fmt, **options)
+    return True
+
+
+def render_variants(upload_folder: str, source: str) -> list:
+    """Write every variant of upload_folder/source and describe them.
+
+    Never upscales: a variant is at most as wide as the original, and
+    kinds that would end up at the same width share one file.
+    """
+    src_path = os.path.join(upload_folder, source)
+    # Variants mirror the source's shard directories
+    stem = os.path.splitext(source)[0]
+    os.makedirs(os.path.join(upload_folder, VARIANTS_DIRNAME, os.path.dirname(stem)), exist_ok=True)
+
+    with Image.open(src_path) as original:
+        original = ImageOps.exif_transpose(original)
+        fallback = 'png' if _has_alpha(original) else 'jpeg'
+        if original.mode not in ('RGB', 'RGBA'):
+            original = original.convert('RGBA' if _has_alpha(original) else 'RGB')
+        variants = []
+        for kind, max_width in VARIANT_WIDTHS.items():
+            width = min(max_width, original.width)
+            height = max(1, round(original.height * width / original.width))
+            resized = None
+            for fmt in ('webp', fallback):
+                filename = f'{VARIANTS_DIRNAME}/{stem}-{width}w{FORMAT_EXTENSIONS[fmt]}'
+                path = os.path.join(upload_folder, filename)
+                if not os.path.exists(path):
+                    if resized is None:
+                        resized = original if width == original.width else original.resize((width, height), Image.LANCZOS)
+                    _save(resized, path, fmt)
+                variants.append({
+                    'kind': kind,
+                    'format': fmt,
+                    'width': width,
+                    'height': height,
+                    'filename': filename,
+                    'bytes': os.path.getsize(path),
+                })
+    return variants
+
+
+def generate_variants(conn, upload_folder: str, source: str) -> list:
+    """Render the variants of one upload and record them in image_variants."""
+    if not available() or not source:
+        return []
+    try:
+        variants = render_variants(upload_folder, source)
+    except (OSError, Image.DecompressionBombError):
+        # Unreadable image: pages keep using the original file
+        logger.exception('Could not render variants for %s', source)
+        return []
+    conn.execute('DELETE FROM image_variants WHERE source = ?', (source,))
+    conn.executemany(
+        """
+        INSERT INTO image_variants (source, kind, format, width, height, filename, bytes)
+        VALUES (:source, :kind, :format, :width, :height, :filename, :bytes)
+        """,
+        [dict(v, source=source) for v in variants],
+    )
+    return variants
+
+
+def fetch_variants(conn, sources, url=upload_url) -> dict:
+    """Return {source: srcset info} for every source that has variants.
+
+    url maps a stored variant filename to the URL it is served from.
+    """
+    sources = sorted({s for s in sources if s})
+    if not sources:
+        return {}
+    placeholders = ', '.join('?' for _ in sources)
+    rows = conn.execute(
+        f"""
+        SELECT source, format, width, filename FROM image_variants
+        WHERE source IN ({placeholders})
+        ORDER BY source, format, width
+        """,
+        sources,
+    ).fetchall()
+    grouped = {}
+    for row in rows:
+        formats = grouped.setdefault(row['source'], {})
+        widths = formats.setdefault(row['format'], {})
+        widths[row['width']] = row['filename']
+    return {source: _srcset_info(formats, url) for source, formats in grouped.items()}
+
+
+def _srcset_info(formats: dict, url) -> dict:
+    def srcset(widths):
+        return ', '.join(f'{url(name)} {width}w' for width, name in sorted(widths.items()))
+
+    fallback_fmt = 'png' if 'png' in formats else 'jpeg'
+    fallback = formats.get(fallback_fmt, {})
+    info = {'sources': []}
+    if 'webp' in formats:
+        info['sources'].append({'type': FORMAT_MIMETYPES['webp'], 'srcset': srcset(formats['webp'])})
+    if fallback:
+        widths = sorted(fallback)
+        # Plain src for browsers without srcset: the card size is plenty
+        src_width = next((w for w in widths if w >= VARIANT_WIDTHS['card']), widths[-1])
+        info['srcset'] = srcset(fallback)
+        info['src'] = url(fallback[src_width])
+    return info
+
+
+def read_image_size(path: str):
+    """Display (width, height) from the image header, without decoding pixels.
+
+    Dimensions are after EXIF orientation, as browsers lay the image out.
+    """
+    with Image.open(path) as img:
+        width, height = img.size
+        if img.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+            width, height = height, width
+    return width, height
+
+
+def describe_image(path: str):
+    """Return display width/height and a tiny blurred data-URI placeholder.
+
+    This decodes the image (JPEGs at reduced scale), so it belongs in
+    background jobs rather than requests.
+    """
+    width, height = read_image_size(path)
+    with Image.open(path) as img:
+        img.draft('RGB', (PLACEHOLDER_SIZE * 8, PLACEHOLDER_SIZE * 8))
+        small = ImageOps.exif_transpose(img).convert('RGB')
+        small.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+        small = small.filter(ImageFilter.GaussianBlur(0.8))
+        buf = io.BytesIO()
+        small.save(buf, 'JPEG', quality=PLACEHOLDER_QUALITY, optimize=True)
+    placeholder = 'data:image/jpeg;base64,' + base64.b64encode(buf.getvalue()).decode('ascii')
+    return {'width': width, 'height': height, 'placeholder': placeholder}
+
+
+def _image_meta(upload_folder: str, name: str, placeholder: bool):
+    path = os.path.join(upload_folder, name)
+    try:
+        if placeholder:
+            return describe_image(path)
+        width, height = read_image_size(path)
+        return {'width': width, 'height': height, 'placeholder': None}
+    except (OSError, Image.DecompressionBombError):
+        logger.exception('Could not read dimensions of %s', name)
+        return None
+
+
+def store_image_meta(conn, upload_folder: str, name: str, placeholder: bool = True) -> bool:
+    """Fill in width and height on an uploads row, and the placeholder unless told not to.
+
+    With placeholder=False only the header is read, which is cheap enough
+    for the upload request; the image_variants job adds the placeholder.
+    """
+    if not available() or not name:
+        return False
+    row = conn.execute('SELECT width, placeholder FROM uploads WHERE name = ?', (name,)).fetchone()
+    if row is None or (row['width'] is not None and (row['placeholder'] is not None or not placeholder)):
+        return False
+    meta = _image_meta(upload_folder, name, placeholder)
+    if meta is None:
+        return False
+    conn.execute(
+        """
+        UPDATE uploads SET width = :width, height = :height, placeholder = COALESCE(:placeholder, placeholder)
+        WHERE name = :name
+        """,
+        dict(meta, name=name),
+    )
+    return True
+
+
+def backfill_image_meta(conn, upload_folder: str, batch_size: int = 50) -> int:
+    """Store dimensions and placeholders for uploads missing them, a batch per commit.
+
+    Images are decoded before the batch's write starts, so the database
+    lock is only held for the updates. Returns how many uploads were filled in.
+    """
+    if not available():
+        return 0
+    described, last = 0, ''
+    while True:
+        names = [row[0] for row in conn.execute(
+            """
+            SELECT name FROM uploads WHERE name > ? AND (width IS NULL OR placeholder IS NULL)
+            ORDER BY name LIMIT ?
+            """,
+            (last, batch_size),
+        )]
+        if not names:
+            return described
+        last = names[-1]
+        batch = []
+        for name in names:
+            if os.path.isfile(os.path.join(upload_folder, name)):
+                meta = _image_meta(upload_folder, name, placeholder=True)
+                if meta is not None:
+                    batch.append(dict(meta, name=name))
+        conn.executemany(
+            'UPDATE uploads SET width = :width, height = :height, placeholder = :placeholder WHERE name = :name',
+            batch,
+        )
+        jobs.heartbeat(conn)
+        conn.commit()
+        described += len(batch)
+
+
+def fetch_image_meta(conn, sources) -> dict:
+    """Return {name: {width, height, placeholder}} for uploads that have them."""
+    sources = sorted({s for s in sources if s})
+    if not sources:
+        return {}
+    placeholders = ', '.join('?' for _ in sources)
+    rows = conn.execute(
+        f'SELECT name, width, height, placeholder FROM uploads WHERE name IN ({placeholders}) AND width IS NOT NULL',
+        sources,
+    ).fetchall()
+    return {row['name']: {'width': row['width'], 'height': row['height'], 'placeholder': row['placeholder']} for row in rows}
+
+
+def attach_variants(conn, posts) -> None:
+    """Set post['variants'] and post['image_meta'] on each post dict, batched."""
+    sources = [p.get('image') for p in posts]
+    variants = fetch_variants(conn, sources)
+    meta = fetch_image_meta(conn, sources)
+    for post in posts:
+        post['variants'] = variants.get(post.get('image'))
+        post['image_meta'] = meta.get(post.get('image'))
+
+
+SOURCE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.webp'}
+
+
+def default_workers() -> int:
+    """Cores this process may run on, which can be fewer than the machine has."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _render_in_worker(folder: str, source: str):
+    # Runs in a pool process: only plain data goes back to the parent
+    try:
+        return render_variants(folder, source), None
+    except (OSError, Image.DecompressionBombError) as exc:
+        return None, f'{type(exc).__name__}: {exc}'
+
+
+def backfill_variants(conn, folder: str, prefix: str = '', workers=None, progress=None) -> dict:
+    """Render variants for every image below folder, in parallel.
+
+    Rows are stored with prefix in front of source and filename names
+    ('assets/' for the assets folder, '' for uploads). Each finished image
+    is committed together with its digest in processed_images, so an
+    interrupted run picks up where it stopped and files whose digest is
+    unchanged are skipped. progress(done, total) is called after every image.
+    """
+    report = {'scanned': 0, 'skipped': 0, 'rendered': 0, 'failed': 0, 'sources': [], 'seconds': 0.0}
+    if not available():
+        return report
+    started = time.perf_counter()
+    processed = dict(conn.execute('SELECT source, digest FROM processed_images').fetchall())
+    pending = {}
+    for name, _ in iter_files(folder, skip=(VARIANTS_DIRNAME,)):
+        if os.path.splitext(name)[1].lower() not in SOURCE_EXTENSIONS:
+            continue
+        report['scanned'] += 1
+        digest = file_sha256(os.path.join(folder, name))
+        if processed.get(prefix + name) == digest:
+            report['skipped'] += 1
+        else:
+            pending[name] = digest
+
+    with ProcessPoolExecutor(max_workers=workers or default_workers()) as pool:
+        futures = {pool.submit(_render_in_worker, folder, name): name for name in sorted(pending)}
+        for done, future in enumerate(as_completed(futures), 1):
+            name = futures[future]
+            variants, error = future.result()
+            if error is not None:
+                logger.warning('Could not render variants for %s%s: %s', prefix, name, error)
+                report['failed'] += 1
+            else:
+                source = prefix + name
+                conn.execute('DELETE FROM image_variants WHERE source = ?', (source,))
+                conn.executemany(
+                    """
+                    INSERT INTO image_variants (source, kind, format, width, height, filename, bytes)
+                    VALUES (:source, :kind, :format, :width, :height, :filename, :bytes)
+                    """,
+                    [dict(v, source=source, filename=prefix + v['filename']) for v in variants],
+                )
+                conn.execute(
+                    'INSERT OR REPLACE INTO processed_images (source, digest, processed_at) VALUES (?, ?, ?)',
+                    (source, pending[name], time.time()),
+                )
+                jobs.heartbeat(conn)
+                conn.commit()
+                report['rendered'] += 1
+                report['sources'].append(source)
+            if progress is not None:
+                progress(done, len(futures))
+    report['seconds'] = time.perf_counter() - started
+    return report
@@ -0,0 +1,268 @@
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+
+
+logger = logging.getLogger(__name__)
+
+# The job the current worker thread is running, for heartbeat()
+_current = threading.local()
+
+
+class JobLost(RuntimeError):
+    """The running job was reclaimed by another worker after its lease ran out."""
+
+
+def enqueue(conn, kind: str, payload: dict, delay: float = 0, max_attempts: int = 3) -> int:
+    """Insert a queued job on conn; it runs once the caller commits."""
+    now = time.time()
+    cur = conn.execute(
+        """
+        INSERT INTO jobs (kind, payload, status, attempts, max_attempts, run_after, created_at, updated_at)
+        VALUES (?, ?, 'queued', 0, ?, ?, ?, ?)
+        """,
+        (kind, json.dumps(payload), max_attempts, now + delay, now, now),
+    )
+    return cur.lastrowid
+
+
+def is_scheduled(conn, kind: str) -> bool:
+    row = conn.execute("SELECT 1 FROM jobs WHERE kind = ? AND status = 'queued' LIMIT 1", (kind,)).fetchone()
+    return row is not None
+
+
+def heartbeat(conn) -> None:
+    """Renew the lease of the job running on this thread; a no-op elsewhere.
+
+    Long handlers call this in each batch, before committing it. A job whose
+    lease has already run out belongs to another worker by now, so
+    JobLost is raised and the batch is rolled back instead of racing it.
+    """
+    job = getattr(_current, 'job', None)
+    if job is None:
+        return
+    cur = conn.execute(
+        "UPDATE jobs SET updated_at = ? WHERE id = ? AND status = 'running' AND attempts = ?",
+        (time.time(), job['id'], job['attempts'] + 1),
+    )
+    if cur.rowcount == 0:
+        raise JobLost(f"Job {job['id']} ({job['kind']}) was reclaimed by another worker")
+
+
+class JobQueue:
+    """Background jobs stored in the SQLite jobs table, run by worker threads.
+
+    enqueue() only inserts a row on the caller's connection, so a job is
+    committed (or rolled back) together with the request that created it.
+    Workers claim jobs inside BEGIN IMMEDIATE, which keeps claims exclusive
+    across threads and worker processes alike. Failed jobs are retried with
+    exponential backoff until max_attempts, then left as 'failed'.
+
+    A claim is a lease of stale_after seconds, renewed by heartbeat(). A job
+    still 'running' past it is taken to have died with its worker and is
+    reclaimed; that counts as an attempt too, so a job that always hangs
+    ends up 'failed' rather than running forever. Finished jobs are pruned
+    once they are older than retain_for.
+    """
+
+    def __init__(self, pool, workers: int = 2, poll_interval: float = 2.0,
+                 retry_delay: float = 5.0, stale_after: float = 600.0,
+                 retain_for: float = 7 * 24 * 3600, prune_interval: float = 3600.0):
+        self.pool = pool
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.stale_after = stale_after
+        self.retain_for = retain_for
+        self.prune_interval = prune_interval
+        self._next_prune = 0.0
+        self.handlers = {}
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._counts_lock = threading.Lock()
+        self._counts = {'completed': 0, 'retried': 0, 'failed': 0, 'reclaimed': 0, 'lost': 0, 'pruned': 0}
+
+    def handler(self, kind: str):
+        """Register fn(conn, payload) as the handler for jobs of this kind."""
+        def register(fn):
+            self.handlers[kind] = fn
+            return fn
+        return register
+
+    def enqueue(self, conn, kind: str, payload: dict, delay: float = 0, max_attempts: int = 3) -> int:
+        return enqueue(conn, kind, payload, delay, max_attempts)
+
+    def is_scheduled(self, conn, kind: str) -> bool:
+        return is_scheduled(conn, kind)
+
+    def notify(self) -> None:
+        """Wake idle workers; call after committing new jobs."""
+        self._wakeup.set()
+
+    def ensure_started(self) -> bool:
+        """Start this process's workers; True only for the call that started them."""
+        # Threads do not survive fork(), so (re)start them per process
+        if self.workers <= 0 or self._pid == os.getpid():
+            return False
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return False
+            self._pid = os.getpid()
+            self._stopping.clear()
+            self._threads = [
+                threading.Thread(target=self._worker, name=f'job-worker-{i}', daemon=True)
+                for i in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+        return True
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        self._pid = None
+
+    def _worker(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                ran = self.run_pending(limit=1)
+            except Exception:
+                logger.exception('Job worker crashed while claiming a job')
+                ran = 0
+            if not ran:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def _claim(self, conn):
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            reclaimed = self._reclaim(conn, now)
+            prune_due = now >= self._next_prune
+            pruned = self.prune(conn, now) if prune_due else 0
+            row = conn.execute(
+                """
+                SELECT id, kind, payload, attempts, max_attempts FROM jobs
+                WHERE status = 'queued' AND run_after <= ?
+                ORDER BY run_after, id
+                LIMIT 1
+                """,
+                (now,),
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                    (now, row['id']),
+                )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        if prune_due:
+            self._next_prune = now + self.prune_interval
+        with self._counts_lock:
+            self._counts['reclaimed'] += reclaimed
+            self._counts['pruned'] += pruned
+        return row
+
+    def _reclaim(self, conn, now: float) -> int:
+        """Requeue, or fail once out of attempts, jobs whose lease ran out."""
+        expired = now - self.stale_after
+        error = f'Lease expired: no heartbeat for {self.stale_after:g}s'
+        conn.execute(
+            """
+            UPDATE jobs SET status = 'failed', last_error = ?, updated_at = ?
+            WHERE status = 'running' AND updated_at < ? AND attempts >= max_attempts
+            """,
+            (error, now, expired),
+        )
+        return conn.execute(
+            "UPDATE jobs SET status = 'queued', last_error = ?, updated_at = ? WHERE status = 'running' AND updated_at < ?",
+            (error, now, expired),
+        ).rowcount
+
+    def prune(self, conn, now=None) -> int:
+        """Delete done and failed jobs older than retain_for; the caller commits."""
+        if now is None:
+            now = time.time()
+        return conn.execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+            (now - self.retain_for,),
+        ).rowcount
+
+    def _finish(self, conn, job, error=None) -> None:
+        now = time.time()
+        attempts = job['attempts'] + 1
+        # Only while the claim is still ours: attempts doubles as the lease token
+        lease = "id = ? AND status = 'running' AND attempts = ?"
+        if error is None:
+            cur = conn.execute(
+                f"UPDATE jobs SET status = 'done', last_error = NULL, updated_at = ? WHERE {lease}",
+                (now, job['id'], attempts),
+            )
+            outcome = 'completed'
+        elif attempts < job['max_attempts']:
+            cur = conn.execute(
+                f"UPDATE jobs SET status = 'queued', run_after = ?, last_error = ?, updated_at = ? WHERE {lease}",
+                (now + self.retry_delay * 2 ** (attempts - 1), error, now, job['id'], attempts),
+            )
+            outcome = 'retried'
+        else:
+            cur = conn.execute(
+                f"UPDATE jobs SET status = 'failed', last_error = ?, updated_at = ? WHERE {lease}",
+                (error, now, job['id'], attempts),
+            )
+            outcome = 'failed'
+        conn.commit()
+        if cur.rowcount == 0:
+            logger.warning('Job %s (%s) finished after it was reclaimed', job['id'], job['kind'])
+            outcome = 'lost'
+        with self._counts_lock:
+            self._counts[outcome] += 1
+
+    def run_pending(self, limit=None) -> int:
+        """Run ready jobs in the calling thread; returns how many ran."""
+        ran = 0
+        conn = self.pool.acquire()
+        try:
+            while limit is None or ran < limit:
+                job = self._claim(conn)
+                if job is None:
+                    break
+                handler = self.handlers.get(job['kind'])
+                error = None
+                _current.job = job
+                try:
+                    if handler is None:
+                        raise LookupError(f"No handler for job kind {job['kind']!r}")
+                    handler(conn, json.loads(job['payload']))
+                    heartbeat(conn)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    error = traceback.format_exc()
+                    logger.warning('Job %s (%s) failed:\n%s', job['id'], job['kind'], error)
+                finally:
+                    _current.job = None
+                self._finish(conn, job, error)
+                ran += 1
+        finally:
+            self.pool.release(conn)
+        return ran
+
+    def stats(self, conn) -> dict:
+        rows = conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        with self._counts_lock:
+            stats = dict(self._counts)
+        stats['by_status'] = {row[0]: row[1] for row in rows}
+        stats['workers'] = len(self._threads) if self._pid == os.getpid() else 0
+        return stats
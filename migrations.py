@@ -0,0 +1,601 @@
+import sqlite3
+from datetime import datetime
+
+import jobs
+from content import backfill_summaries, split_tags, strip_legacy_tags, summarize
+from locks import file_lock
+from roadmap import evenly_spaced_keys
+from search import rebuild_index
+from tags import set_post_tags
+
+
+# Ordered (version, name, upgrade) entries, registered with @migration.
+MIGRATIONS = []
+
+
+def migration(version: int, name: str):
+    def register(upgrade):
+        MIGRATIONS.append((version, name, upgrade))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return upgrade
+    return register
+
+
+def head_version() -> int:
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def current_version(conn) -> int:
+    try:
+        row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    except sqlite3.OperationalError:
+        # schema_version does not exist yet
+        return 0
+    return row[0] or 0
+
+
+def migrate(conn, lock_path: str) -> list:
+    """Apply pending migrations and return the versions that were applied.
+
+    When the database is already at head this is a single read. Otherwise
+    the first process to take the file lock migrates and the others wait,
+    re-check and find nothing left to do.
+    """
+    if current_version(conn) >= head_version():
+        return []
+
+    applied = []
+    with file_lock(lock_path):
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TEXT NOT NULL
+            )
+            """
+        )
+        current = current_version(conn)
+        for version, name, upgrade in MIGRATIONS:
+            if version <= current:
+                continue
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                upgrade(conn)
+                conn.execute(
+                    'INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)',
+                    (version, name, datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
+                )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            applied.append(version)
+    return applied
+
+
+# Before migration 5 tags were a trailing "Tags: ..." line in the post body;
+# this expression pulls that line out so it can be indexed in its own column.
+LEGACY_TAGS_SQL = (
+    "CASE WHEN instr({col}, char(10) || 'Tags: ') > 0 "
+    "THEN substr({col}, instr({col}, char(10) || 'Tags: ') + 7) ELSE '' END"
+)
+
+
+def _column_names(conn, table: str) -> set:
+    return {c[1] for c in conn.execute(f'PRAGMA table_info({table})').fetchall()}
+
+
+def _drop_column(conn, table: str, column: str) -> None:
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        conn.execute(f'ALTER TABLE {table} DROP COLUMN {column}')
+        return
+    # Older SQLite has no DROP COLUMN: rebuild the table without it, then
+    # restore its indexes and triggers
+    create_sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()[0]
+    primary_key = 'PRIMARY KEY AUTOINCREMENT' if 'AUTOINCREMENT' in create_sql.upper() else 'PRIMARY KEY'
+    names, definitions = [], []
+    for _, name, col_type, notnull, default, pk in conn.execute(f'PRAGMA table_info({table})').fetchall():
+        if name == column:
+            continue
+        parts = [name, col_type, primary_key if pk else '', 'NOT NULL' if notnull else '']
+        if default is not None:
+            parts.append(f'DEFAULT {default}')
+        names.append(name)
+        definitions.append(' '.join(part for part in parts if part))
+    dependents = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE tbl_name = ? AND type IN ('index', 'trigger') AND sql IS NOT NULL",
+        (table,),
+    ).fetchall()
+    columns = ', '.join(names)
+    conn.execute(f'CREATE TABLE {table}_rebuild ({", ".join(definitions)})')
+    conn.execute(f'INSERT INTO {table}_rebuild ({columns}) SELECT {columns} FROM {table}')
+    conn.execute(f'DROP TABLE {table}')
+    conn.execute(f'ALTER TABLE {table}_rebuild RENAME TO {table}')
+    for (sql,) in dependents:
+        conn.execute(sql)
+
+
+def _schedule_upload_migration(conn) -> None:
+    # Per-file work on the upload archive runs as a job that commits in
+    # batches; migrations only queue it, so boot never waits on file I/O
+    if not jobs.is_scheduled(conn, 'migrate_uploads'):
+        jobs.enqueue(conn, 'migrate_uploads', {})
+
+
+@migration(1, 'initial schema')
+def _initial_schema(conn):
+    # Databases created before versioning already have some of this, so
+    # every step is conditional.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS posts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT,
+            content TEXT,
+            date TEXT
+        )
+        """
+    )
+    if 'image' not in _column_names(conn, 'posts'):
+        conn.execute('ALTER TABLE posts ADD COLUMN image TEXT')
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS resources (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            url TEXT NOT NULL,
+            order_index INTEGER NOT NULL
+        )
+        """
+    )
+    res_col_names = _column_names(conn, 'resources')
+    if 'branch' not in res_col_names:
+        conn.execute("ALTER TABLE resources ADD COLUMN branch TEXT DEFAULT 'main'")
+    if 'parent_id' not in res_col_names:
+        conn.execute('ALTER TABLE resources ADD COLUMN parent_id INTEGER NULL')
+
+
+@migration(2, 'remove legacy welcome resource')
+def _remove_welcome(conn):
+    conn.execute("DELETE FROM resources WHERE LOWER(title) = 'welcome'")
+
+
+@migration(3, 'precomputed post excerpts')
+def _post_excerpts(conn):
+    conn.execute('ALTER TABLE posts ADD COLUMN excerpt TEXT')
+    conn.execute('ALTER TABLE posts ADD COLUMN word_count INTEGER')
+    conn.execute('ALTER TABLE posts ADD COLUMN reading_time INTEGER')
+    backfill_summaries(conn)
+
+
+@migration(4, 'full-text search index')
+def _posts_fts(conn):
+    legacy_tags = LEGACY_TAGS_SQL.format(col='new.content')
+    conn.execute(
+        """
+        CREATE VIRTUAL TABLE posts_fts USING fts5(
+            title, content, tags,
+            tokenize = 'porter unicode61 remove_diacritics 2'
+        )
+        """
+    )
+    conn.execute(
+        f"""
+        CREATE TRIGGER posts_fts_ai AFTER INSERT ON posts BEGIN
+            INSERT INTO posts_fts (rowid, title, content, tags)
+            VALUES (new.id, new.title, new.content, {legacy_tags});
+        END
+        """
+    )
+    conn.execute(
+        f"""
+        CREATE TRIGGER posts_fts_au AFTER UPDATE OF title, content ON posts BEGIN
+            UPDATE posts_fts SET title = new.title, content = new.content, tags = {legacy_tags}
+            WHERE rowid = new.id;
+        END
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER posts_fts_ad AFTER DELETE ON posts BEGIN
+            DELETE FROM posts_fts WHERE rowid = old.id;
+        END
+        """
+    )
+    conn.execute(
+        f"""
+        INSERT INTO posts_fts (rowid, title, content, tags)
+        SELECT id, title, content, {LEGACY_TAGS_SQL.format(col='content')} FROM posts
+        """
+    )
+
+
+@migration(5, 'normalized tags')
+def _tags(conn):
+    conn.execute(
+        """
+        CREATE TABLE tags (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            slug TEXT NOT NULL UNIQUE,
+            post_count INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE post_tags (
+            tag_id INTEGER NOT NULL,
+            post_id INTEGER NOT NULL,
+            PRIMARY KEY (tag_id, post_id)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute('CREATE INDEX idx_post_tags_post ON post_tags (post_id, tag_id)')
+
+    # Counts and the search index's tags column follow post_tags
+    tags_for_post = """
+        UPDATE posts_fts SET tags = COALESCE((
+            SELECT group_concat(t.name, ' ')
+            FROM post_tags pt JOIN tags t ON t.id = pt.tag_id
+            WHERE pt.post_id = {post}
+        ), '') WHERE rowid = {post};
+    """
+    conn.execute(
+        f"""
+        CREATE TRIGGER post_tags_ai AFTER INSERT ON post_tags BEGIN
+            UPDATE tags SET post_count = post_count + 1 WHERE id = new.tag_id;
+            {tags_for_post.format(post='new.post_id')}
+        END
+        """
+    )
+    conn.execute(
+        f"""
+        CREATE TRIGGER post_tags_ad AFTER DELETE ON post_tags BEGIN
+            UPDATE tags SET post_count = post_count - 1 WHERE id = old.tag_id;
+            {tags_for_post.format(post='old.post_id')}
+        END
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER posts_tags_ad AFTER DELETE ON posts BEGIN
+            DELETE FROM post_tags WHERE post_id = old.id;
+        END
+        """
+    )
+
+    # The search triggers no longer read tags out of the body
+    conn.execute('DROP TRIGGER posts_fts_ai')
+    conn.execute('DROP TRIGGER posts_fts_au')
+    conn.execute(
+        """
+        CREATE TRIGGER posts_fts_ai AFTER INSERT ON posts BEGIN
+            INSERT INTO posts_fts (rowid, title, content, tags)
+            VALUES (new.id, new.title, new.content, '');
+        END
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER posts_fts_au AFTER UPDATE OF title, content ON posts BEGIN
+            UPDATE posts_fts SET title = new.title, content = new.content
+            WHERE rowid = new.id;
+        END
+        """
+    )
+
+    # Move existing "Tags:" lines out of post bodies
+    rows = conn.execute("SELECT id, content FROM posts WHERE content LIKE '%Tags:%'").fetchall()
+    for row in rows:
+        body, raw = strip_legacy_tags(row['content'])
+        if not raw:
+            continue
+        summary = summarize(body)
+        conn.execute(
+            'UPDATE posts SET content = ?, excerpt = ?, word_count = ?, reading_time = ? WHERE id = ?',
+            (body, summary['excerpt'], summary['word_count'], summary['reading_time'], row['id']),
+        )
+        set_post_tags(conn, row['id'], split_tags(raw))
+    # posts_fts still keeps its own copy of the text at this version
+    conn.execute('DELETE FROM posts_fts')
+    conn.execute(
+        """
+        INSERT INTO posts_fts (rowid, title, content, tags)
+        SELECT p.id, p.title, p.content, COALESCE((
+            SELECT group_concat(t.name, ' ')
+            FROM post_tags pt JOIN tags t ON t.id = pt.tag_id
+            WHERE pt.post_id = p.id
+        ), '')
+        FROM posts p
+        """
+    )
+
+
+@migration(6, 'revision counters for conditional requests')
+def _revisions(conn):
+    now = "CAST(strftime('%s', 'now') AS INTEGER)"
+    for table in ('posts', 'resources'):
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN revision INTEGER NOT NULL DEFAULT 1')
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN updated_at INTEGER')
+        conn.execute(f'UPDATE {table} SET updated_at = {now}')
+    conn.execute(
+        """
+        CREATE TABLE content_revisions (
+            scope TEXT PRIMARY KEY,
+            revision INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        f"INSERT INTO content_revisions (scope, revision, updated_at) VALUES ('posts', 1, {now}), ('resources', 1, {now})"
+    )
+
+    # Row revisions move whenever a visible column changes
+    conn.execute(
+        f"""
+        CREATE TRIGGER posts_revision_au AFTER UPDATE OF title, content, date, image ON posts BEGIN
+            UPDATE posts SET revision = old.revision + 1, updated_at = {now} WHERE id = new.id;
+        END
+        """
+    )
+    conn.execute(
+        f"""
+        CREATE TRIGGER resources_revision_au AFTER UPDATE OF title, url, order_index, branch, parent_id ON resources BEGIN
+            UPDATE resources SET revision = old.revision + 1, updated_at = {now} WHERE id = new.id;
+        END
+        """
+    )
+    for event, row in (('INSERT', 'new'), ('DELETE', 'old')):
+        conn.execute(
+            f"""
+            CREATE TRIGGER post_tags_revision_{event.lower()} AFTER {event} ON post_tags BEGIN
+                UPDATE posts SET revision = revision + 1, updated_at = {now} WHERE id = {row}.post_id;
+            END
+            """
+        )
+
+    # Listing revisions move on any change to their table
+    for table in ('posts', 'resources'):
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            conn.execute(
+                f"""
+                CREATE TRIGGER {table}_scope_{event.lower()} AFTER {event} ON {table} BEGIN
+                    UPDATE content_revisions SET revision = revision + 1, updated_at = {now}
+                    WHERE scope = '{table}';
+                END
+                """
+            )
+
+
+@migration(7, 'responsive image variants')
+def _image_variants(conn):
+    conn.execute(
+        """
+        CREATE TABLE image_variants (
+            source TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            format TEXT NOT NULL,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            filename TEXT NOT NULL,
+            bytes INTEGER NOT NULL,
+            PRIMARY KEY (source, kind, format)
+        ) WITHOUT ROWID
+        """
+    )
+
+
+@migration(8, 'background jobs')
+def _jobs(conn):
+    conn.execute(
+        """
+        CREATE TABLE jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 3,
+            run_after REAL NOT NULL,
+            last_error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """
+    )
+    conn.execute('CREATE INDEX idx_jobs_ready ON jobs (status, run_after)')
+    # Job handlers look posts up by their image
+    conn.execute('CREATE INDEX idx_posts_image ON posts (image)')
+
+
+@migration(9, 'content-addressed uploads')
+def _uploads(conn):
+    conn.execute(
+        """
+        CREATE TABLE uploads (
+            name TEXT PRIMARY KEY,
+            digest TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL
+        )
+        """
+    )
+    conn.execute('CREATE INDEX idx_uploads_digest ON uploads (digest)')
+    conn.execute(
+        """
+        CREATE TRIGGER posts_uploads_ai AFTER INSERT ON posts WHEN new.image IS NOT NULL BEGIN
+            UPDATE uploads SET refcount = refcount + 1 WHERE name = new.image;
+        END
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER posts_uploads_au AFTER UPDATE OF image ON posts WHEN new.image IS NOT old.image BEGIN
+            UPDATE uploads SET refcount = refcount - 1 WHERE name = old.image;
+            UPDATE uploads SET refcount = refcount + 1 WHERE name = new.image;
+        END
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER posts_uploads_ad AFTER DELETE ON posts WHEN old.image IS NOT NULL BEGIN
+            UPDATE uploads SET refcount = refcount - 1 WHERE name = old.image;
+        END
+        """
+    )
+    # The timestamp-named files posts already point at are hashed and
+    # registered by the 'migrate_uploads' job, outside this transaction
+    _schedule_upload_migration(conn)
+
+
+@migration(10, 'variant lookup by filename')
+def _variant_filename_index(conn):
+    # The upload garbage collector checks variant files by name
+    conn.execute('CREATE INDEX idx_image_variants_filename ON image_variants (filename)')
+
+
+@migration(11, 'processed image digests')
+def _processed_images(conn):
+    # Lets the variant backfill resume: a source whose content was already
+    # rendered is skipped, and one whose file changed is rendered again
+    conn.execute(
+        """
+        CREATE TABLE processed_images (
+            source TEXT PRIMARY KEY,
+            digest TEXT NOT NULL,
+            processed_at REAL NOT NULL
+        ) WITHOUT ROWID
+        """
+    )
+
+
+@migration(12, 'image dimensions and placeholders')
+def _image_meta(conn):
+    for column in ('width INTEGER', 'height INTEGER', 'placeholder TEXT'):
+        conn.execute(f'ALTER TABLE uploads ADD COLUMN {column}')
+    # Decoding every upload is left to the 'migrate_uploads' job; pages
+    # render without the placeholder until it has run
+    _schedule_upload_migration(conn)
+
+
+@migration(13, 'sharded upload directories')
+def _shard_uploads(conn):
+    # Moving stored files to their two-level hashed paths is the
+    # 'migrate_uploads' job's work (uploads.shard_uploads), batch by batch
+    _schedule_upload_migration(conn)
+
+
+@migration(14, 'sparse sort keys for resources')
+def _resource_sort_keys(conn):
+    conn.execute('ALTER TABLE resources ADD COLUMN sort_key TEXT')
+    # Fold NULL branches into 'main' first so the two get one key sequence
+    conn.execute("UPDATE resources SET branch = 'main' WHERE branch IS NULL")
+    branches = [row[0] for row in conn.execute('SELECT DISTINCT branch FROM resources')]
+    for branch in branches:
+        ids = [row[0] for row in conn.execute(
+            'SELECT id FROM resources WHERE branch = ? ORDER BY order_index, id', (branch,)
+        )]
+        conn.executemany(
+            'UPDATE resources SET sort_key = ? WHERE id = ?', list(zip(evenly_spaced_keys(len(ids)), ids))
+        )
+
+    # order_index is superseded; the revision trigger names it, so swap that first
+    now = "CAST(strftime('%s', 'now') AS INTEGER)"
+    conn.execute('DROP TRIGGER resources_revision_au')
+    _drop_column(conn, 'resources', 'order_index')
+    conn.execute(
+        f"""
+        CREATE TRIGGER resources_revision_au AFTER UPDATE OF title, url, sort_key, branch, parent_id ON resources BEGIN
+            UPDATE resources SET revision = old.revision + 1, updated_at = {now} WHERE id = new.id;
+        END
+        """
+    )
+    conn.execute('CREATE INDEX idx_resources_branch_sort ON resources (branch, sort_key)')
+
+
+@migration(15, 'index resource fork points')
+def _resource_parent_index(conn):
+    # Dangling fork points (the parent was deleted) would hide a branch from subtree queries
+    conn.execute('UPDATE resources SET parent_id = NULL WHERE parent_id NOT IN (SELECT id FROM resources)')
+    conn.execute('CREATE INDEX idx_resources_parent ON resources (parent_id)')
+
+
+@migration(16, 'external-content search index')
+def _posts_fts_external(conn):
+    # posts_fts stored a second copy of every post; index posts_search instead
+    for trigger in ('posts_fts_ai', 'posts_fts_au', 'posts_fts_ad', 'post_tags_ai', 'post_tags_ad'):
+        conn.execute(f'DROP TRIGGER {trigger}')
+    conn.execute('DROP TABLE posts_fts')
+    # Tags in name order, so a row always reads back exactly as it was indexed
+    conn.execute(
+        """
+        CREATE VIEW posts_search AS
+        SELECT p.id, p.title, p.content, COALESCE((
+            SELECT group_concat(name, ' ') FROM (
+                SELECT t.name FROM post_tags pt JOIN tags t ON t.id = pt.tag_id
+                WHERE pt.post_id = p.id ORDER BY t.name
+            )
+        ), '') AS tags
+        FROM posts p
+        """
+    )
+    conn.execute(
+        """
+        CREATE VIRTUAL TABLE posts_fts USING fts5(
+            title, content, tags,
+            content = 'posts_search', content_rowid = 'id',
+            tokenize = 'porter unicode61 remove_diacritics 2'
+        )
+        """
+    )
+
+    # An external-content index is told what to remove, so every change
+    # drops the row's old entry before it happens and adds the new one after
+    index_post = """
+        INSERT INTO posts_fts (rowid, title, content, tags)
+        SELECT id, title, content, tags FROM posts_search WHERE id = {post};
+    """
+    unindex_post = """
+        INSERT INTO posts_fts (posts_fts, rowid, title, content, tags)
+        SELECT 'delete', id, title, content, tags FROM posts_search WHERE id = {post};
+    """
+    triggers = (
+        ('posts_fts_ai', 'AFTER INSERT ON posts', index_post.format(post='new.id')),
+        ('posts_fts_bu', 'BEFORE UPDATE OF title, content ON posts', unindex_post.format(post='old.id')),
+        ('posts_fts_au', 'AFTER UPDATE OF title, content ON posts', index_post.format(post='new.id')),
+        ('posts_fts_bd', 'BEFORE DELETE ON posts', unindex_post.format(post='old.id')),
+        ('post_tags_bi', 'BEFORE INSERT ON post_tags', unindex_post.format(post='new.post_id')),
+        (
+            'post_tags_ai', 'AFTER INSERT ON post_tags',
+            'UPDATE tags SET post_count = post_count + 1 WHERE id = new.tag_id;' + index_post.format(post='new.post_id'),
+        ),
+        ('post_tags_bd', 'BEFORE DELETE ON post_tags', unindex_post.format(post='old.post_id')),
+        (
+            'post_tags_ad', 'AFTER DELETE ON post_tags',
+            'UPDATE tags SET post_count = post_count - 1 WHERE id = old.tag_id;' + index_post.format(post='old.post_id'),
+        ),
+    )
+    for name, event, body in triggers:
+        conn.execute(f'CREATE TRIGGER {name} {event} BEGIN {body} END')
+    rebuild_index(conn)
+
+
+@migration(17, 'unique resource sort keys')
+def _unique_resource_sort_keys(conn):
+    # Concurrent appends could write the same key twice; re-key those branches
+    branches = [row[0] for row in conn.execute(
+        'SELECT DISTINCT branch FROM resources GROUP BY branch, sort_key HAVING COUNT(*) > 1'
+    )]
+    for branch in branches:
+        ids = [row[0] for row in conn.execute(
+            'SELECT id FROM resources WHERE branch = ? ORDER BY sort_key, id', (branch,)
+        )]
+        conn.executemany(
+            'UPDATE resources SET sort_key = ? WHERE id = ?', list(zip(evenly_spaced_keys(len(ids)), ids))
+        )
+    conn.execute('DROP INDEX idx_resources_branch_sort')
+    conn.execute('CREATE UNIQUE INDEX idx_resources_branch_sort ON resources (branch, sort_key)')
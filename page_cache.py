@@ -0,0 +1,70 @@
+import threading
+from collections import OrderedDict
+
+
+class PageCache:
+    """In-process LRU cache of rendered response bodies.
+
+    Keys start with the endpoint name so mutating routes can drop every
+    cached page of the endpoints they affect. Bounded by entry count and by
+    total body size, whichever is hit first.
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'invalidations': 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.max_bytes > 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry
+
+    def set(self, key, body: bytes, mimetype: str) -> None:
+        if not self.enabled or len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[0])
+            self._entries[key] = (body, mimetype)
+            self._bytes += len(body)
+            self._stats['stores'] += 1
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, *endpoints) -> int:
+        """Drop cached pages for the given endpoints, or everything if none given."""
+        with self._lock:
+            if endpoints:
+                keys = [k for k in self._entries if k[0] in endpoints]
+            else:
+                keys = list(self._entries)
+            for key in keys:
+                body, _ = self._entries.pop(key)
+                self._bytes -= len(body)
+            self._stats['invalidations'] += len(keys)
+            return len(keys)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        stats['max_entries'] = self.max_entries
+        stats['max_bytes'] = self.max_bytes
+        return stats
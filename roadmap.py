@@ -0,0 +1,419 @@
+import threading
+from collections import OrderedDict
+
+
+# Resources are ordered within their branch by sparse sort keys: a new
+# position is always a key strictly between two neighbours, so adding,
+# deleting or moving a resource writes exactly one row. Keys are base-62
+# digit strings compared as fractions (they never end in the lowest digit),
+# which SQLite's default BINARY collation already orders correctly.
+DIGITS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+BASE = len(DIGITS)
+# Keys grow by about one digit per six inserts at the same spot; past this
+# length the branch is queued for rebalancing.
+REBALANCE_KEY_LENGTH = 12
+# Free slots left between neighbours by evenly_spaced_keys()
+KEY_SPACING = BASE
+# evenly_spaced_keys() fills only 1/KEY_HEADROOM of the key space, leaving
+# the rest above the last key for key_after() to append into
+KEY_HEADROOM = BASE
+
+
+def key_between(before, after) -> str:
+    """Return a key that sorts after before and before after (None = open end)."""
+    before = before or ''
+    if after is not None and not before < after:
+        raise ValueError(f'{before!r} does not sort before {after!r}')
+    if after is not None:
+        # Keep the shared prefix and split the remainder
+        n = 0
+        while n < len(after) and (before[n] if n < len(before) else DIGITS[0]) == after[n]:
+            n += 1
+        if n:
+            return after[:n] + key_between(before[n:], after[n:])
+    low = DIGITS.index(before[0]) if before else 0
+    high = DIGITS.index(after[0]) if after is not None else BASE
+    if high - low > 1:
+        return DIGITS[(low + high) // 2]
+    if after is not None and len(after) > 1:
+        return after[0]
+    return DIGITS[low] + key_between(before[1:], None)
+
+
+def key_after(before) -> str:
+    """Next key after before at its own length: its last digit plus one.
+
+    Appending this way keeps keys the same length for as long as there is
+    room above before, so a branch only grows by appends without ever
+    queueing a rebalance. Only a key of all top digits needs key_between().
+    """
+    if not before:
+        return evenly_spaced_keys(1)[0]
+    digits = [DIGITS.index(c) for c in before]
+    i = len(digits) - 1
+    while i >= 0 and digits[i] == BASE - 1:
+        i -= 1
+    if i < 0:
+        return key_between(before, None)
+    digits[i] += 1
+    if i < len(digits) - 1:
+        # Carried: keep the length, and never end in the lowest digit
+        digits[i + 1:] = [0] * (len(digits) - i - 2) + [1]
+    return ''.join(DIGITS[d] for d in digits)
+
+
+def evenly_spaced_keys(count: int) -> list:
+    """Return count ascending keys KEY_SPACING apart, low in the key space."""
+    width = 1
+    while BASE ** width < (count + 1) * KEY_SPACING * KEY_HEADROOM:
+        width += 1
+    keys = []
+    for i in range(1, count + 1):
+        value, digits = KEY_SPACING * i, []
+        for _ in range(width):
+            value, digit = divmod(value, BASE)
+            digits.append(DIGITS[digit])
+        keys.append(''.join(reversed(digits)).rstrip(DIGITS[0]))
+    return keys
+
+
+def needs_rebalance(key: str) -> bool:
+    return len(key) > REBALANCE_KEY_LENGTH
+
+
+def append_key(conn, branch: str) -> str:
+    """Key that places a new resource last in its branch."""
+    row = conn.execute(
+        'SELECT sort_key FROM resources WHERE branch = ? ORDER BY sort_key DESC LIMIT 1', (branch,)
+    ).fetchone()
+    return key_after(row['sort_key'] if row else None)
+
+
+def neighbour_key(conn, resource, direction: str):
+    """Key one step up or down from resource, or None when it is already at that end.
+
+    Only the two resources it has to pass are read, through the
+    (branch, sort_key) index.
+    """
+    if direction == 'up':
+        rows = conn.execute(
+            'SELECT sort_key FROM resources WHERE branch = ? AND sort_key < ? ORDER BY sort_key DESC LIMIT 2',
+            (resource['branch'], resource['sort_key']),
+        ).fetchall()
+        if not rows:
+            return None
+        return key_between(rows[1]['sort_key'] if len(rows) > 1 else None, rows[0]['sort_key'])
+    rows = conn.execute(
+        'SELECT sort_key FROM resources WHERE branch = ? AND sort_key > ? ORDER BY sort_key LIMIT 2',
+        (resource['branch'], resource['sort_key']),
+    ).fetchall()
+    if not rows:
+        return None
+    if len(rows) == 1:
+        return key_after(rows[0]['sort_key'])
+    return key_between(rows[0]['sort_key'], rows[1]['sort_key'])
+
+
+def branches_to_rebalance(conn) -> list:
+    rows = conn.execute(
+        'SELECT DISTINCT branch FROM resources WHERE length(sort_key) > ?', (REBALANCE_KEY_LENGTH,)
+    ).fetchall()
+    return [row['branch'] for row in rows]
+
+
+def rebalance(conn, branch: str) -> int:
+    """Rewrite a branch's keys evenly spaced, keeping their order."""
+    ids = [row['id'] for row in conn.execute(
+        'SELECT id FROM resources WHERE branch = ? ORDER BY sort_key, id', (branch,)
+    )]
+    keys = evenly_spaced_keys(len(ids))
+    # Clear first: (branch, sort_key) is unique, and a new key may still be
+    # some later row's old one
+    conn.execute('UPDATE resources SET sort_key = NULL WHERE branch = ?', (branch,))
+    conn.executemany('UPDATE resources SET sort_key = ? WHERE id = ?', list(zip(keys, ids)))
+    return len(ids)
+
+
+def resources_version(conn) -> int:
+    """Revision of the resources table, bumped by triggers on every change."""
+    row = conn.execute("SELECT revision FROM content_revisions WHERE scope = 'resources'").fetchone()
+    return row['revision']
+
+
+def branch_ids(conn, branch: str) -> list:
+    rows = conn.execute('SELECT id FROM resources WHERE branch = ? ORDER BY sort_key, id', (branch,)).fetchall()
+    return [row['id'] for row in rows]
+
+
+def reorder(conn, branch: str, ids: list) -> list:
+    """Give a branch exactly the order of ids; returns the keys written.
+
+    ids must name every resource of the branch once. Rows already in
+    order relative to their new neighbours keep their key; the rest get a
+    key between the neighbours that were settled before them.
+    """
+    current = branch_ids(conn, branch)
+    if sorted(ids) != sorted(current):
+        raise ValueError('order must list every resource of the branch exactly once')
+    keys = dict(conn.execute(
+        'SELECT id, sort_key FROM resources WHERE branch = ?', (branch,)
+    ).fetchall())
+    keep = _longest_increasing(ids, keys)
+    moved = []
+    for i, res_id in enumerate(ids):
+        if res_id in keep:
+            continue
+        before = keys[ids[i - 1]] if i > 0 else None
+        after = next((keys[other] for other in ids[i + 1:] if other in keep), None)
+        keys[res_id] = key_after(before) if after is None else key_between(before, after)
+        moved.append((keys[res_id], res_id))
+    # Moved rows give up their keys first, as in rebalance()
+    conn.executemany('UPDATE resources SET sort_key = NULL WHERE id = ?', [(res_id,) for _, res_id in moved])
+    conn.executemany('UPDATE resources SET sort_key = ? WHERE id = ?', moved)
+    return [key for key, _ in moved]
+
+
+def _longest_increasing(ids: list, keys: dict) -> set:
+    """Ids forming the longest run already in ascending key order (patience sorting)."""
+    tails, tail_index, parent = [], [], {}
+    for res_id in ids:
+        key = keys[res_id]
+        lo, hi = 0, len(tails)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if tails[mid] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        parent[res_id] = tail_index[lo - 1] if lo else None
+        if lo == len(tails):
+            tails.append(key)
+            tail_index.append(res_id)
+        else:
+            tails[lo] = key
+            tail_index[lo] = res_id
+    keep, res_id = set(), tail_index[-1] if tail_index else None
+    while res_id is not None:
+        keep.add(res_id)
+        res_id = parent[res_id]
+    return keep
+
+
+def move_to(conn, resource, position: int) -> str:
+    """Put resource at a 0-based position in its branch, writing one row."""
+    rows = conn.execute(
+        """
+        SELECT sort_key FROM resources WHERE branch = ? AND id != ?
+        ORDER BY sort_key, id LIMIT 2 OFFSET ?
+        """,
+        (resource['branch'], resource['id'], max(position - 1, 0)),
+    ).fetchall()
+    if position <= 0:
+        before, after = None, rows[0]['sort_key'] if rows else None
+    else:
+        before = rows[0]['sort_key'] if rows else None
+        after = rows[1]['sort_key'] if len(rows) > 1 else None
+        if before is None:
+            # Past the end: go last
+            before = conn.execute(
+                'SELECT MAX(sort_key) FROM resources WHERE branch = ? AND id != ?', (resource['branch'], resource['id'])
+            ).fetchone()[0]
+    sort_key = key_after(before) if after is None else key_between(before, after)
+    conn.execute('UPDATE resources SET sort_key = ? WHERE id = ?', (sort_key, resource['id']))
+    return sort_key
+
+
+def fetch_subtree(conn, branch: str) -> list:
+    """Resources of branch and of every branch forking off it, at any depth."""
+    rows = conn.execute(
+        """
+        WITH RECURSIVE tree(branch) AS (
+            SELECT ?
+            UNION
+            SELECT child.branch FROM tree
+            JOIN resources AS fork ON fork.branch = tree.branch
+            JOIN resources AS child ON child.parent_id = fork.id
+        )
+        SELECT id, title, url, sort_key, branch, parent_id FROM resources
+        WHERE branch IN tree
+        ORDER BY branch ASC, sort_key ASC, id ASC
+        """,
+        (branch,),
+    ).fetchall()
+    return [dict(r) for r in rows]
+
+
+def branch_parent(conn, branch: str):
+    """(exists, parent_id) of a branch; its resources all share the fork point."""
+    row = conn.execute('SELECT parent_id FROM resources WHERE branch = ? LIMIT 1', (branch,)).fetchone()
+    return (True, row['parent_id']) if row else (False, None)
+
+
+def detach_forks(conn, resource) -> int:
+    """Re-point branches forking off resource to its predecessor before it goes away."""
+    row = conn.execute(
+        'SELECT id FROM resources WHERE branch = ? AND sort_key < ? ORDER BY sort_key DESC LIMIT 1',
+        (resource['branch'], resource['sort_key']),
+    ).fetchone()
+    new_parent = row['id'] if row else resource['parent_id']
+    return conn.execute(
+        'UPDATE resources SET parent_id = ? WHERE parent_id = ?', (new_parent, resource['id'])
+    ).rowcount
+
+
+# Layout geometry, in SVG user units. The first lane keeps the original
+# single-track look: a 600 high canvas with the track at 58%.
+STEP_X = 420
+TAIL_X = 200
+SEGMENT_X = 300
+WAVE_Y = 50
+FIRST_LANE_Y = 348
+LANE_HEIGHT = 240
+CANVAS_HEIGHT = 600
+
+
+def layout(resources: list) -> dict:
+    """Place resources on lanes, one lane per branch, in O(resources + branches).
+
+    resources must be grouped by branch and ordered by sort_key within it,
+    as fetch_resources() and fetch_subtree() return them. A branch starts
+    one step right of the resource it forks from and takes the next free
+    lane below, in depth-first order; branches whose fork point is missing
+    (or that fork in a cycle) are laid out as roots, 'main' first.
+    """
+    branches, position = {}, {}
+    for r in resources:
+        items = branches.setdefault(r['branch'], [])
+        position[r['id']] = r['branch']
+        items.append(r)
+
+    forks = {}
+    roots = []
+    for branch, items in branches.items():
+        parent = items[0]['parent_id']
+        if parent is None or position.get(parent, branch) == branch:
+            roots.append(branch)
+        else:
+            forks.setdefault(parent, []).append(branch)
+    roots.sort(key=lambda b: (b != 'main', b))
+
+    nodes, tracks, placed = [], [], set()
+    column, lane_y = {}, {}
+
+    def place(root, start, fork):
+        # Iterative DFS so deep fork chains cannot hit the recursion limit
+        stack = [(root, start, fork)]
+        while stack:
+            branch, start, fork = stack.pop()
+            if branch in placed:
+                continue
+            placed.add(branch)
+            y = FIRST_LANE_Y + LANE_HEIGHT * len(tracks)
+            items = branches[branch]
+            children = []
+            for i, r in enumerate(items):
+                col = start + i
+                column[r['id']], lane_y[r['id']] = col, y
+                after = items[i - 1]['id'] if i else (fork['id'] if fork else None)
+                nodes.append({
+                    'id': r['id'], 'title': r['title'], 'url': r['url'], 'branch': branch,
+                    'x': col * STEP_X, 'y': y, 'after': after,
+                })
+                for child in forks.get(r['id'], ()):
+                    children.append((child, col + 1, {'id': r['id'], 'x': col * STEP_X, 'y': y}))
+            tracks.append({
+                'branch': branch, 'y': y, 'fork': fork,
+                'x0': start * STEP_X, 'x1': (start + len(items) - 1) * STEP_X,
+            })
+            stack.extend(reversed(children))
+
+    for branch in roots:
+        place(branch, 0, None)
+    # Whatever is left forks in a cycle; break it by treating it as a root
+    for branch in branches:
+        if branch not in placed:
+            place(branch, 0, None)
+
+    width = max((t['x1'] for t in tracks), default=0) + STEP_X + TAIL_X
+    height = CANVAS_HEIGHT + LANE_HEIGHT * max(len(tracks) - 1, 0)
+    for order_index, node in enumerate(nodes):
+        node['order_index'] = order_index
+        node['y_pct'] = node['y'] * 100 / height
+    for track in tracks:
+        track['d'] = build_path(track, width)
+    # Nodes bucketed by column, for nodes_between()
+    columns = [[] for _ in range(width // STEP_X)]
+    for node in nodes:
+        columns[node['x'] // STEP_X].append(node)
+    return {'nodes': nodes, 'tracks': tracks, 'width': width, 'height': height, 'columns': columns}
+
+
+def nodes_between(layout: dict, x0: int, x1: int) -> list:
+    """Nodes of a layout with x0 <= x < x1, read straight from their columns."""
+    columns = layout['columns']
+    first = max(-(-x0 // STEP_X), 0)
+    last = min(-(-x1 // STEP_X), len(columns))
+    return [node for column in columns[first:last] for node in column]
+
+
+def build_path(track: dict, width: int) -> str:
+    """Wavy SVG path along a track, curving in from its fork point if any."""
+    y = int(track['y'])
+    end = min(track['x1'] + STEP_X + TAIL_X, width) - 50
+    fork = track['fork']
+    if fork:
+        start = track['x0']
+        bend = fork['x'] + STEP_X // 2
+        parts = [f"M {fork['x']} {int(fork['y'])} C {bend} {int(fork['y'])}, {bend} {y}, {start} {y}"]
+    else:
+        start = 0
+        parts = [f"M 0 {y}"]
+    # One S command per segment, alternating above and below the lane
+    for i, x in enumerate(range(start, end, SEGMENT_X)):
+        toggle = -1 if i % 2 else 1
+        parts.append(f"S {x + SEGMENT_X // 2} {y - WAVE_Y * toggle}, {min(end, x + SEGMENT_X)} {y + WAVE_Y * toggle}")
+    return ' '.join(parts)
+
+
+class LayoutCache:
+    """Computed layouts keyed by (branch, resources version).
+
+    Every resources write bumps the version, so entries never go stale;
+    storing a new version drops the older ones, and writers in this
+    process clear() as well to free them straight away.
+    """
+
+    def __init__(self, max_entries: int = 16):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0}
+
+    def get(self, key, build):
+        """Return the layout for key, calling build() to compute it on a miss."""
+        with self._lock:
+            hit = self._entries.get(key)
+            if hit is not None:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return hit
+            self._stats['misses'] += 1
+        value = build()
+        with self._lock:
+            version = key[-1]
+            for old in [k for k in self._entries if k[-1] < version]:
+                del self._entries[old]
+            self._entries[key] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        return stats
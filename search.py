@@ -0,0 +1,97 @@
+import re
+
+from markupsafe import Markup, escape
+
+
+# Column weights for bm25(): title, content, tags
+BM25_WEIGHTS = (10.0, 1.0, 5.0)
+SNIPPET_TOKENS = 24
+
+# snippet() wraps matches in these control characters; they are swapped for
+# <mark> only after the surrounding post text has been HTML-escaped.
+_MARK_OPEN = '\x02'
+_MARK_CLOSE = '\x03'
+
+_TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def build_match_query(q: str) -> str:
+    """Turn free text into a safe FTS5 query: every word, prefix-matched."""
+    terms = _TERM_RE.findall(q or '')
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def highlight(snippet: str) -> Markup:
+    text = str(escape(snippet or ''))
+    return Markup(text.replace(_MARK_OPEN, '<mark>').replace(_MARK_CLOSE, '</mark>'))
+
+
+def encode_cursor(score: float, post_id: int) -> str:
+    return f'{score!r}:{post_id}'
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        score, post_id = cursor.rsplit(':', 1)
+        return float(score), int(post_id)
+    except ValueError:
+        return None
+
+
+def search_posts(conn, q: str, cursor=None, limit: int = 10):
+    """Return (results, next_cursor) for q ranked by BM25.
+
+    Pages are keyed on (score, id) so later pages never re-read the rows
+    already shown.
+    """
+    match = build_match_query(q)
+    if not match:
+        return [], None
+    after = decode_cursor(cursor)
+    params = {
+        'match': match,
+        'limit': limit + 1,
+        'open': _MARK_OPEN,
+        'close': _MARK_CLOSE,
+        'tokens': SNIPPET_TOKENS,
+    }
+    keyset = ''
+    if after is not None:
+        keyset = 'WHERE hits.score > :score OR (hits.score = :score AND hits.id > :after_id)'
+        params['score'], params['after_id'] = after
+    rows = conn.execute(
+        f"""
+        SELECT hits.id, hits.score, hits.snippet, p.title, p.date, p.image
+        FROM (
+            SELECT rowid AS id,
+                   bm25(posts_fts, {', '.join(map(str, BM25_WEIGHTS))}) AS score,
+                   snippet(posts_fts, 1, :open, :close, '...', :tokens) AS snippet
+            FROM posts_fts
+            WHERE posts_fts MATCH :match
+        ) AS hits
+        JOIN posts p ON p.id = hits.id
+        {keyset}
+        ORDER BY hits.score, hits.id
+        LIMIT :limit
+        """,
+        params,
+    ).fetchall()
+    results = [dict(row) for row in rows[:limit]]
+    for result in results:
+        result['snippet'] = highlight(result['snippet'])
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = encode_cursor(results[-1]['score'], results[-1]['id'])
+    return results, next_cursor
+
+
+def rebuild_index(conn) -> int:
+    # posts_fts indexes the posts_search view without storing the text itself
+    conn.execute("INSERT INTO posts_fts (posts_fts) VALUES ('rebuild')")
+    return conn.execute('SELECT COUNT(*) FROM posts').fetchone()[0]
+
+
+def optimize_index(conn) -> None:
+    conn.execute("INSERT INTO posts_fts (posts_fts) VALUES ('optimize')")
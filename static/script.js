@@ -14,20 +14,48 @@ document.addEventListener('mousemove', (event) => {
 // Blog slider
 document.addEventListener("DOMContentLoaded", () => {
   const track = document.getElementById("blog-track");
-  const blogs = document.querySelectorAll(".blog-card");
+  if (!track) return;
   let current = 0;
+  let loading = null;
+
+  function slideCount() {
+    return track.querySelectorAll(".blog-card").length;
+  }
 
   function updateSlide() {
     track.style.transform = `translateX(-${current * 100}%)`;
   }
 
-  document.getElementById("nextBlog")?.addEventListener("click", () => {
-    current = (current + 1) % blogs.length;
+  // Fetch the next page of posts once the slider reaches its last card
+  function loadMore() {
+    const cursor = track.dataset.nextCursor;
+    if (!cursor) return Promise.resolve(false);
+    if (!loading) {
+      loading = fetch(`/api/posts?before=${encodeURIComponent(cursor)}`)
+        .then(res => res.ok ? res.json() : Promise.reject(res))
+        .then(data => {
+          track.insertAdjacentHTML("beforeend", data.html);
+          if (data.next_cursor) {
+            track.dataset.nextCursor = data.next_cursor;
+          } else {
+            delete track.dataset.nextCursor;
+          }
+          return true;
+        })
+        .catch(() => false)
+        .finally(() => { loading = null; });
+    }
+    return loading;
+  }
+
+  document.getElementById("nextBlog")?.addEventListener("click", async () => {
+    if (current === slideCount() - 1) await loadMore();
+    current = (current + 1) % slideCount();
     updateSlide();
   });
 
   document.getElementById("prevBlog")?.addEventListener("click", () => {
-    current = (current - 1 + blogs.length) % blogs.length;
+    current = (current - 1 + slideCount()) % slideCount();
     updateSlide();
   });
 
@@ -92,32 +120,47 @@ try {
 // Resources roadmap progression
 if (document.body.classList.contains('resources-page')) {
   const key = 'void_roadmap_progress';
-  const checkpoints = Array.from(document.querySelectorAll('.checkpoint'));
+  const container = document.querySelector('.checkpoints');
+  const scroller = document.getElementById('road-scroll');
   const fog = document.querySelector('.fog-mask');
   const glowStop = document.getElementById('glow-stop');
   const glowCut = document.getElementById('glow-cut');
+  const canvasWidth = parseFloat(container.getAttribute('data-canvas-width') || '1');
+  const total = parseInt(container.getAttribute('data-total') || '0', 10);
+  // Long roadmaps come without checkpoints; only those near the view are materialized
+  const windowUrl = container.getAttribute('data-roadmap-url');
+  const chunk = parseInt(container.getAttribute('data-chunk') || '4200', 10);
+  const known = new Map();
 
-  // Apply absolute positions from data attributes
-  checkpoints.forEach(cp => {
+  function place(cp) {
     const xpct = parseFloat(cp.getAttribute('data-xpct') || '0');
     const ypct = parseFloat(cp.getAttribute('data-ypct') || '60');
     cp.style.left = xpct + '%';
     cp.style.top = ypct + '%';
-  });
+    known.set(idFor(cp), { xpct, after: cp.getAttribute('data-after') });
+  }
+
+  // Apply absolute positions from data attributes
+  container.querySelectorAll('.checkpoint').forEach(place);
 
   function idFor(cp) { return cp.getAttribute('data-id'); }
   function orderFor(cp) { return parseInt(cp.getAttribute('data-order') || '0', 10); }
 
-  const ordered = checkpoints.slice().sort((a, b) => orderFor(a) - orderFor(b));
+  function ordered() {
+    return Array.from(container.querySelectorAll('.checkpoint')).sort((a, b) => orderFor(a) - orderFor(b));
+  }
 
   function getProgress() { try { return JSON.parse(localStorage.getItem(key) || '[]'); } catch { return []; } }
   function setProgress(progress) { localStorage.setItem(key, JSON.stringify(progress)); }
 
   function refresh() {
     const progress = getProgress();
-    ordered.forEach((cp, idx) => {
+    const present = ordered();
+    present.forEach(cp => {
       const done = progress.includes(idFor(cp));
-      const prevCompleted = idx === 0 || progress.includes(idFor(ordered[idx - 1]));
+      // Each checkpoint follows the one before it on its branch, or the fork point
+      const after = cp.getAttribute('data-after');
+      const prevCompleted = !after || progress.includes(after);
       const unlocked = (prevCompleted || done);
       const btn = cp.querySelector('.mark-btn');
       cp.classList.toggle('locked', !unlocked);
@@ -131,7 +174,7 @@ if (document.body.classList.contains('resources-page')) {
           setProgress(progress);
           refresh();
           updateGlowAndFog();
-          const next = ordered[idx + 1];
+          const next = present.find(other => other.getAttribute('data-after') === idFor(cp));
           if (next) next.scrollIntoView({ behavior: 'smooth', inline: 'center', block: 'nearest' });
         };
       }
@@ -141,13 +184,11 @@ if (document.body.classList.contains('resources-page')) {
   function updateGlowAndFog() {
     const progress = getProgress();
     let pct = 0;
-    ordered.forEach(cp => {
-      if (!progress.includes(idFor(cp))) return;
-      const xpct = parseFloat(cp.getAttribute('data-xpct') || '0');
-      pct = Math.max(pct, xpct);
+    known.forEach((node, id) => {
+      if (progress.includes(id)) pct = Math.max(pct, node.xpct);
     });
     // If all checkpoints completed, force 100%
-    const allCompleted = progress.length >= ordered.length && ordered.length > 0;
+    const allCompleted = progress.length >= total && total > 0;
     if (allCompleted) pct = 100;
 
     // Set a hard cutoff so the glow fills from the very left to `pct`.
@@ -155,12 +196,107 @@ if (document.body.classList.contains('resources-page')) {
     if (glowStop) glowStop.setAttribute('offset', `${pct}%`);
 
     // Keep fog mask logic as-is (reveal around the last card area)
-    const last = ordered[ordered.length - 1];
-    const lastPct = last ? parseFloat(last.getAttribute('data-xpct') || '100') : 100;
+    const lastPct = parseFloat(container.getAttribute('data-last-xpct') || '100');
     const reveal = Math.min(99, lastPct);
     if (fog) fog.style.setProperty('--fog-reveal', `${reveal}%`);
   }
 
+  function build(node) {
+    const cp = document.createElement('div');
+    cp.className = 'checkpoint';
+    cp.setAttribute('data-id', `cp-${node.id}`);
+    cp.setAttribute('data-order', node.order_index);
+    cp.setAttribute('data-branch', node.branch);
+    cp.setAttribute('data-after', node.after ? `cp-${node.after}` : '');
+    cp.setAttribute('data-xpct', (node.x / canvasWidth) * 100);
+    cp.setAttribute('data-ypct', node.y_pct);
+    const card = document.createElement('div');
+    card.className = 'card';
+    const title = document.createElement('h3');
+    title.textContent = node.title;
+    const link = document.createElement('a');
+    link.href = node.url;
+    link.target = '_blank';
+    link.rel = 'noreferrer';
+    link.className = 'link';
+    link.textContent = 'Open resource';
+    const btn = document.createElement('button');
+    btn.className = 'mark-btn';
+    btn.type = 'button';
+    btn.textContent = 'Mark complete';
+    card.append(title, link, btn);
+    cp.appendChild(card);
+    place(cp);
+    return cp;
+  }
+
+  if (windowUrl && scroller) {
+    const loaded = new Map();
+    let pending = false;
+
+    // Scroll position in SVG units; the track is drawn at least canvasWidth px wide
+    function visibleRange() {
+      const scale = container.scrollWidth / canvasWidth;
+      const x0 = scroller.scrollLeft / scale;
+      const span = scroller.clientWidth / scale;
+      return [x0 - span, x0 + 2 * span];
+    }
+
+    async function loadChunk(index) {
+      const url = new URL(windowUrl, window.location.href);
+      url.searchParams.set('x0', index * chunk);
+      url.searchParams.set('x1', (index + 1) * chunk);
+      const res = await fetch(url, { credentials: 'same-origin' });
+      if (!res.ok) throw new Error(`Roadmap request failed (${res.status})`);
+      return (await res.json()).nodes;
+    }
+
+    async function update() {
+      pending = false;
+      const [x0, x1] = visibleRange();
+      const first = Math.max(0, Math.floor(x0 / chunk));
+      const last = Math.floor(Math.min(x1, canvasWidth) / chunk);
+      // Drop chunks well outside the window so the DOM stays small
+      loaded.forEach((els, index) => {
+        if (index >= first - 1 && index <= last + 1) return;
+        els.forEach(el => el.remove());
+        loaded.delete(index);
+      });
+      const wanted = [];
+      for (let index = first; index <= last; index++) {
+        if (!loaded.has(index)) {
+          const els = [];
+          loaded.set(index, els);
+          wanted.push([index, els]);
+        }
+      }
+      await Promise.all(wanted.map(async ([index, els]) => {
+        try {
+          const nodes = await loadChunk(index);
+          if (loaded.get(index) !== els) return;  // scrolled away meanwhile
+          els.push(...nodes.map(build));
+          container.append(...els);
+        } catch (e) {
+          if (loaded.get(index) === els) loaded.delete(index);
+        }
+      }));
+      if (wanted.length) {
+        refresh();
+        updateGlowAndFog();
+      }
+    }
+
+    function schedule() {
+      if (pending) return;
+      pending = true;
+      requestAnimationFrame(update);
+    }
+
+    scroller.addEventListener('scroll', schedule, { passive: true });
+    window.addEventListener('resize', schedule);
+    update();
+  }
+
   refresh();
   updateGlowAndFog();
 }
@@ -179,3 +315,172 @@ if (document.body.classList.contains('resources-page')) {
   document.addEventListener('scroll', onScroll, { passive: true });
   onScroll();
 })();
+
+// Resumable chunked upload of the admin cover image
+(function() {
+  const input = document.querySelector('input[type="file"][data-chunked-upload]');
+  if (!input) return;
+  const form = input.form;
+  const target = form.querySelector('input[name="uploaded_image"]');
+  const status = form.querySelector('.upload-status');
+  const MAX_RETRIES = 5;
+
+  function say(text) { if (status) status.textContent = text; }
+  function sleep(ms) { return new Promise(resolve => setTimeout(resolve, ms)); }
+
+  const CRC_TABLE = Array.from({ length: 256 }, (_, n) => {
+    let c = n;
+    for (let k = 0; k < 8; k++) c = c & 1 ? 0xEDB88320 ^ (c >>> 1) : c >>> 1;
+    return c >>> 0;
+  });
+
+  // SHA-256 needs a secure context; plain-http admin pages fall back to CRC32
+  async function checksum(buffer) {
+    if (window.crypto && crypto.subtle) {
+      const digest = await crypto.subtle.digest('SHA-256', buffer);
+      return 'sha256=' + Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('');
+    }
+    let crc = 0xFFFFFFFF;
+    for (const byte of new Uint8Array(buffer)) crc = CRC_TABLE[(crc ^ byte) & 0xFF] ^ (crc >>> 8);
+    return 'crc32=' + ((crc ^ 0xFFFFFFFF) >>> 0).toString(16).padStart(8, '0');
+  }
+
+  async function request(url, options) {
+    for (let attempt = 0; ; attempt++) {
+      try {
+        const res = await fetch(url, Object.assign({ credentials: 'same-origin' }, options));
+        if (res.status < 500) return res;
+      } catch (err) {
+        // Network error: retry below
+      }
+      if (attempt >= MAX_RETRIES) throw new Error('Upload failed, please try again');
+      await sleep(500 * 2 ** attempt);
+    }
+  }
+
+  // Start a new upload, or pick up one begun earlier for the same file
+  async function begin(file) {
+    const key = `upload:${file.name}:${file.size}:${file.lastModified}`;
+    const saved = localStorage.getItem(key);
+    if (saved) {
+      const res = await request(`/api/uploads/${saved}`);
+      if (res.ok) return { key, state: await res.json() };
+      localStorage.removeItem(key);
+    }
+    const res = await request('/api/uploads', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ filename: file.name, size: file.size }),
+    });
+    if (!res.ok) throw new Error(res.status === 413 ? 'Image is too large' : 'Image type not supported');
+    const state = await res.json();
+    localStorage.setItem(key, state.id);
+    return { key, state };
+  }
+
+  async function upload(file) {
+    const { key, state } = await begin(file);
+    let offset = state.offset;
+    while (offset < file.size) {
+      say(`Uploading… ${Math.floor(offset * 100 / file.size)}%`);
+      const chunk = await file.slice(offset, offset + state.chunk_size).arrayBuffer();
+      const res = await request(`/api/uploads/${state.id}?offset=${offset}`, {
+        method: 'PUT',
+        headers: { 'Content-Type': 'application/octet-stream', 'X-Chunk-Checksum': await checksum(chunk) },
+        body: chunk,
+      });
+      if (res.status === 409) {
+        // Out of step (a retried chunk had already landed): ask where to resume
+        offset = (await (await request(`/api/uploads/${state.id}`)).json()).offset;
+        continue;
+      }
+      if (!res.ok) {
+        localStorage.removeItem(key);
+        throw new Error(res.status === 415 ? 'Image type not supported' : 'Upload rejected');
+      }
+      offset = (await res.json()).offset;
+    }
+    say('Processing…');
+    const res = await request(`/api/uploads/${state.id}/finalize`, { method: 'POST' });
+    localStorage.removeItem(key);
+    if (!res.ok) throw new Error('Upload could not be completed');
+    return (await res.json()).name;
+  }
+
+  form.addEventListener('submit', async (event) => {
+    const file = input.files[0];
+    if (!file || target.value) return;
+    event.preventDefault();
+    const button = form.querySelector('button[type="submit"]');
+    if (button) button.disabled = true;
+    try {
+      target.value = await upload(file);
+      // The file itself is already stored; post only the form fields
+      input.value = '';
+      say('Uploaded');
+      form.submit();
+    } catch (err) {
+      say(err.message);
+      if (button) button.disabled = false;
+    }
+  });
+})();
+
+// Drag-and-drop reordering of roadmap resources in the admin
+(function() {
+  const list = document.querySelector('[data-reorder-url]');
+  if (!list) return;
+  let dragged = null;
+
+  function renumber() {
+    const counts = {};
+    list.querySelectorAll('.resource-item').forEach(item => {
+      const branch = item.dataset.branch;
+      counts[branch] = (counts[branch] || 0) + 1;
+      const position = item.querySelector('.resource-position');
+      if (position) position.textContent = counts[branch];
+    });
+  }
+
+  async function save(branch) {
+    const order = Array.from(list.querySelectorAll(`.resource-item[data-branch="${CSS.escape(branch)}"]`))
+      .map(item => parseInt(item.dataset.id, 10));
+    const res = await fetch(list.dataset.reorderUrl, {
+      method: 'POST',
+      credentials: 'same-origin',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ version: parseInt(list.dataset.version, 10), branch, order }),
+    });
+    if (!res.ok) {
+      // Someone else changed the roadmap (409) or the request failed: show the real order
+      window.location.reload();
+      return;
+    }
+    list.dataset.version = (await res.json()).version;
+  }
+
+  list.addEventListener('dragstart', (event) => {
+    dragged = event.target.closest('.resource-item');
+    if (!dragged) return;
+    event.dataTransfer.effectAllowed = 'move';
+    dragged.classList.add('opacity-50');
+  });
+
+  list.addEventListener('dragover', (event) => {
+    const over = event.target.closest('.resource-item');
+    if (!dragged || !over || over === dragged || over.dataset.branch !== dragged.dataset.branch) return;
+    event.preventDefault();
+    const rect = over.getBoundingClientRect();
+    const after = event.clientY > rect.top + rect.height / 2;
+    over.parentNode.insertBefore(dragged, after ? over.nextSibling : over);
+  });
+
+  list.addEventListener('dragend', () => {
+    if (!dragged) return;
+    dragged.classList.remove('opacity-50');
+    const branch = dragged.dataset.branch;
+    dragged = null;
+    renumber();
+    save(branch);
+  });
+})();
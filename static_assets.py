@@ -0,0 +1,235 @@
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+from urllib.parse import quote, unquote
+
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip variants are still built
+    brotli = None
+
+
+DIGEST_LENGTH = 12
+CHUNK_SIZE = 64 * 1024
+
+# Text formats worth compressing; images and fonts are compressed already
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.json', '.txt', '.html', '.xml', '.map', '.ico'}
+MIN_COMPRESS_SIZE = 1024
+# Preferred first when the client accepts both at the same quality
+ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+# url(...) references inside stylesheets, quoted or not
+CSS_URL_PATTERN = re.compile(r'''url\(\s*(['"]?)([^'")]+?)\1\s*\)''')
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:DIGEST_LENGTH]
+
+
+class AssetManifest:
+    """Maps public asset paths to content digests for cache-busting URLs.
+
+    roots maps a URL prefix ('' for static/, 'assets/' for assets/) to the
+    directory it is served from. Paths under any of the skip directories
+    (user uploads, build output) are left out because they change at runtime.
+
+    Stylesheets are copied into build_dir with their url() references
+    pointing at fingerprinted URLs, and hashed after that rewrite, so fonts
+    and images they load are cached as long as the stylesheet is.
+    """
+
+    def __init__(self, roots: dict, skip=('uploads',), build_dir=None):
+        self.roots = roots
+        self.skip = set(skip)
+        self.build_dir = build_dir
+        self.entries = {}
+        self.rewritten = set()
+
+    @property
+    def version(self) -> str:
+        digest = hashlib.sha256(json.dumps(self.entries, sort_keys=True).encode())
+        return digest.hexdigest()[:8]
+
+    def build(self) -> dict:
+        entries = {}
+        for prefix, root in self.roots.items():
+            for dirpath, dirnames, filenames in os.walk(root):
+                rel_dir = os.path.relpath(dirpath, root)
+                dirnames[:] = [
+                    d for d in dirnames
+                    if not d.startswith('.') and not (rel_dir == '.' and d in self.skip)
+                ]
+                for name in filenames:
+                    if name.startswith('.') or is_precompressed_variant(dirpath, name):
+                        continue
+                    rel = os.path.normpath(os.path.join(rel_dir, name)).replace(os.sep, '/')
+                    entries[prefix + rel] = file_digest(os.path.join(dirpath, name))
+        self.entries = entries
+        self.rewritten = set()
+        if self.build_dir is not None:
+            # After everything else is hashed, so the URLs written in are final
+            for path in sorted(p for p in entries if p.endswith('.css')):
+                self._rewrite_css(path)
+        return entries
+
+    def _rewrite_css(self, path: str) -> None:
+        directory, name = self.resolve(path)
+        with open(os.path.join(directory, name), encoding='utf-8') as fh:
+            css = fh.read()
+        rewritten = CSS_URL_PATTERN.sub(lambda m: self._css_url(path, m), css)
+        if rewritten == css:
+            return
+        out_path = os.path.join(self.build_dir, *path.split('/'))
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        data = rewritten.encode('utf-8')
+        # Unchanged output keeps its mtime, so precompressed copies stay valid
+        try:
+            with open(out_path, 'rb') as fh:
+                unchanged = fh.read() == data
+        except FileNotFoundError:
+            unchanged = False
+        if not unchanged:
+            _write_atomic(out_path, data)
+        self.entries[path] = file_digest(out_path)
+        self.rewritten.add(path)
+
+    def _css_url(self, css_path: str, match) -> str:
+        ref = match.group(2).strip()
+        # Keep any ?query or #fragment (font-face hacks use them) as written
+        target, suffix = re.match(r'([^?#]*)(.*)', ref).groups()
+        if not target or ':' in target or target.startswith('//'):
+            return match.group(0)
+        if target.startswith('/'):
+            asset = target.lstrip('/')
+        else:
+            asset = posixpath.normpath(posixpath.join(posixpath.dirname(css_path), target))
+        asset = unquote(asset)
+        if asset not in self.entries:
+            return match.group(0)
+        return f"url('{self.url(asset)}{suffix}')"
+
+    def load(self, path: str) -> bool:
+        if not os.path.exists(path):
+            return False
+        with open(path) as fh:
+            data = json.load(fh)
+        if 'entries' not in data:
+            return False  # written before stylesheets were rewritten
+        rewritten = set(data['rewritten'])
+        if rewritten and (self.build_dir is None or not all(
+            os.path.isfile(os.path.join(self.build_dir, *p.split('/'))) for p in rewritten
+        )):
+            return False
+        self.entries = data['entries']
+        self.rewritten = rewritten
+        return True
+
+    def save(self, path: str) -> None:
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as fh:
+            json.dump({'entries': self.entries, 'rewritten': sorted(self.rewritten)}, fh, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    def resolve(self, path: str):
+        """Return (directory, filename) for a manifest path, longest prefix first.
+
+        Rewritten stylesheets resolve to their copy in build_dir.
+        """
+        if path in self.rewritten:
+            return self.build_dir, path
+        for prefix in sorted(self.roots, key=len, reverse=True):
+            if path.startswith(prefix):
+                return self.roots[prefix], path[len(prefix):]
+        return None
+
+    def url(self, path: str) -> str:
+        path = path.lstrip('/')
+        digest = self.entries.get(path)
+        if digest is None:
+            return '/' + quote(path)
+        return f'/fp/{digest}/{quote(path)}'
+
+
+def is_compressible(filename: str) -> bool:
+    return os.path.splitext(filename)[1].lower() in COMPRESSIBLE_EXTENSIONS
+
+
+def is_precompressed_variant(directory: str, name: str) -> bool:
+    base, ext = os.path.splitext(name)
+    return ext in ENCODING_SUFFIXES.values() and os.path.exists(os.path.join(directory, base))
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fh:
+        fh.write(data)
+    os.replace(tmp_path, path)
+
+
+def precompress(roots, skip=('uploads',), force: bool = False) -> dict:
+    """Write .gz (and .br when brotli is installed) next to compressible files.
+
+    Variants are rewritten only when older than their source, and dropped
+    when they would not be smaller. Returns byte totals for reporting.
+    """
+    totals = {'files': 0, 'original': 0, 'gzip': 0, 'br': 0}
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            if os.path.relpath(dirpath, root) == '.':
+                dirnames[:] = [d for d in dirnames if d not in skip]
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if not is_compressible(name) or os.path.getsize(path) < MIN_COMPRESS_SIZE:
+                    continue
+                with open(path, 'rb') as fh:
+                    data = fh.read()
+                totals['files'] += 1
+                totals['original'] += len(data)
+                encoders = {'gzip': lambda d: gzip.compress(d, compresslevel=9, mtime=0)}
+                if brotli is not None:
+                    encoders['br'] = lambda d: brotli.compress(d, quality=11)
+                for encoding, encode in encoders.items():
+                    variant = path + ENCODING_SUFFIXES[encoding]
+                    if not force and os.path.exists(variant) and os.path.getmtime(variant) >= os.path.getmtime(path):
+                        totals[encoding] += os.path.getsize(variant)
+                        continue
+                    compressed = encode(data)
+                    if len(compressed) >= len(data):
+                        if os.path.exists(variant):
+                            os.remove(variant)
+                        continue
+                    _write_atomic(variant, compressed)
+                    totals[encoding] += len(compressed)
+    return totals
+
+
+def pick_encoding(directory: str, filename: str, accept_encodings):
+    """Return the best precompressed (encoding, variant filename) or None.
+
+    accept_encodings is werkzeug's request.accept_encodings. A variant is
+    only used when it is at least as new as the file it was built from.
+    """
+    source = safe_join(directory, filename)
+    if source is None or not is_compressible(filename):
+        return None
+    best = None
+    for encoding, suffix in ENCODING_SUFFIXES.items():
+        quality = accept_encodings[encoding]
+        if quality <= 0 or (best is not None and quality <= best[0]):
+            continue
+        try:
+            if os.path.getmtime(source + suffix) < os.path.getmtime(source):
+                continue
+        except OSError:
+            continue
+        best = (quality, encoding, filename + suffix)
+    return best[1:] if best else None
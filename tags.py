@@ -0,0 +1,64 @@
+from content import slugify
+
+
+def set_post_tags(conn, post_id: int, names: list) -> None:
+    """Make post_id carry exactly the given tags, touching only the difference.
+
+    tags.post_count and the search index are kept up to date by the
+    post_tags triggers.
+    """
+    wanted = {}
+    for name in names:
+        slug = slugify(name)
+        conn.execute('INSERT OR IGNORE INTO tags (name, slug) VALUES (?, ?)', (name, slug))
+        wanted[conn.execute('SELECT id FROM tags WHERE slug = ?', (slug,)).fetchone()[0]] = name
+    current = {
+        row[0] for row in conn.execute('SELECT tag_id FROM post_tags WHERE post_id = ?', (post_id,))
+    }
+    conn.executemany(
+        'DELETE FROM post_tags WHERE tag_id = ? AND post_id = ?',
+        [(tag_id, post_id) for tag_id in current - wanted.keys()],
+    )
+    conn.executemany(
+        'INSERT INTO post_tags (tag_id, post_id) VALUES (?, ?)',
+        [(tag_id, post_id) for tag_id in wanted.keys() - current],
+    )
+
+
+def fetch_post_tags(conn, post_id: int) -> list:
+    rows = conn.execute(
+        """
+        SELECT t.id, t.name, t.slug, t.post_count
+        FROM post_tags pt JOIN tags t ON t.id = pt.tag_id
+        WHERE pt.post_id = ?
+        ORDER BY t.name
+        """,
+        (post_id,),
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def fetch_tag(conn, slug: str):
+    row = conn.execute('SELECT id, name, slug, post_count FROM tags WHERE slug = ?', (slug,)).fetchone()
+    return dict(row) if row else None
+
+
+def fetch_tag_posts_page(conn, tag_id: int, before=None, limit: int = 10):
+    """Return one page of a tag's posts newest first, plus the next cursor.
+
+    Walks the (tag_id, post_id) primary key of post_tags, so a page is an
+    index range scan however many posts carry the tag.
+    """
+    rows = conn.execute(
+        """
+        SELECT p.id, p.title, p.excerpt, p.reading_time, p.date, p.image
+        FROM post_tags pt JOIN posts p ON p.id = pt.post_id
+        WHERE pt.tag_id = ? AND pt.post_id < ?
+        ORDER BY pt.post_id DESC
+        LIMIT ?
+        """,
+        (tag_id, before if before is not None else 2 ** 63 - 1, limit + 1),
+    ).fetchall()
+    posts = [dict(row) for row in rows[:limit]]
+    next_cursor = posts[-1]['id'] if len(rows) > limit else None
+    return posts, next_cursor
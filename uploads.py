@@ -0,0 +1,582 @@
+import hashlib
+import json
+import os
+import re
+import secrets
+import shutil
+import tempfile
+import time
+import zlib
+from urllib.parse import quote
+
+from werkzeug.exceptions import BadRequest, Conflict, NotFound, RequestEntityTooLarge, UnsupportedMediaType
+
+import jobs
+from locks import file_lock
+
+
+UPLOAD_FOLDER = os.path.join(os.path.dirname(__file__), 'static', 'uploads')
+# Uploads still being received or checked are staged outside static/, so
+# nothing unvetted is ever served. Keep it on the same filesystem as the
+# upload folder: ingesting a file is a rename.
+INCOMING_FOLDER = os.environ.get('UPLOAD_INCOMING_DIR', os.path.join(os.path.dirname(__file__), 'upload-incoming'))
+CHUNK_SIZE = 64 * 1024
+# Staging directory inside the upload folder used by older releases
+INCOMING_DIRNAME = '.incoming'
+VARIANTS_DIRNAME = 'variants'
+GC_BATCH_SIZE = 500
+# Files hashed or moved per committed batch when migrating legacy uploads
+MIGRATE_BATCH_SIZE = 100
+
+# Leading bytes of each accepted image format and the extension it is stored under
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'GIF87a', '.gif'),
+    (b'GIF89a', '.gif'),
+)
+SNIFF_BYTES = 12
+
+
+def new_temp_path(incoming: str) -> str:
+    os.makedirs(incoming, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=incoming)
+    os.close(fd)
+    return tmp_path
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def blob_name(digest: str, ext: str) -> str:
+    """Stored name for content: two levels of hash prefix, e.g. 'ab/cd/abcd….png'.
+
+    At most 256 entries per level keeps every directory small however large
+    the archive grows.
+    """
+    return f'{digest[:2]}/{digest[2:4]}/{digest}{ext.lower()}'
+
+
+def upload_url(name: str) -> str:
+    return '/uploads/' + quote(name)
+
+
+def ingest_file(conn, folder: str, tmp_path: str, ext: str, digest=None) -> str:
+    """Move a finished temp file into the store under its SHA-256 name.
+
+    If the same content is already stored the temp file is dropped instead.
+    Either way the uploads row exists afterwards; posts referencing the name
+    keep its refcount up to date through triggers. The row is written
+    first: that takes the write lock collect_garbage() holds while it
+    unlinks, so the file is never judged present just before it goes.
+    """
+    if digest is None:
+        digest = file_sha256(tmp_path)
+    name = blob_name(digest, ext)
+    final_path = os.path.join(folder, name)
+    size = os.path.getsize(tmp_path)
+    conn.execute(
+        'INSERT OR IGNORE INTO uploads (name, digest, size, refcount, created_at) VALUES (?, ?, ?, 0, ?)',
+        (name, digest, size, time.time()),
+    )
+    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+    if os.path.exists(final_path):
+        os.remove(tmp_path)
+        # Fresh mtime keeps the garbage collector's grace period honest
+        os.utime(final_path)
+    else:
+        try:
+            os.replace(tmp_path, final_path)
+        except FileNotFoundError:
+            # The collector pruned the shard directory in between; recreate it
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.replace(tmp_path, final_path)
+    return name
+
+
+def delete_if_unreferenced(conn, folder: str, name: str) -> bool:
+    """Delete a blob now, rather than after the GC grace period, if no post uses it.
+
+    Commits; the file is unlinked under the write lock, as in collect_garbage().
+    """
+    deleted = conn.execute(
+        'DELETE FROM uploads WHERE name = ? AND refcount <= 0 RETURNING name', (name,)
+    ).fetchall()
+    removed = bool(deleted) and _remove(os.path.join(folder, name))
+    conn.commit()
+    return removed
+
+
+def register_legacy_uploads(conn, folder: str, batch_size: int = MIGRATE_BATCH_SIZE) -> dict:
+    """Add uploads rows for files posts reference that the store does not know yet.
+
+    Posts from before content addressing point at timestamp-named files.
+    Each batch is hashed first and then written and committed on its own,
+    so an interrupted run loses at most one batch and the next run skips
+    everything already registered.
+    """
+    report = {'registered': 0, 'missing': 0}
+    last = ''
+    while True:
+        names = [row[0] for row in conn.execute(
+            """
+            SELECT DISTINCT image FROM posts
+            WHERE image > ? AND image NOT IN (SELECT name FROM uploads)
+            ORDER BY image LIMIT ?
+            """,
+            (last, batch_size),
+        )]
+        if not names:
+            return report
+        last = names[-1]
+        found = []
+        for name in names:
+            path = os.path.join(folder, name)
+            if not os.path.isfile(path):
+                report['missing'] += 1
+                continue
+            stat = os.stat(path)
+            found.append((name, file_sha256(path), stat.st_size, name, stat.st_mtime))
+        # Triggers keep refcount current from here on; count what is there now
+        conn.executemany(
+            """
+            INSERT OR IGNORE INTO uploads (name, digest, size, refcount, created_at)
+            VALUES (?, ?, ?, (SELECT COUNT(*) FROM posts WHERE image = ?), ?)
+            """,
+            found,
+        )
+        jobs.heartbeat(conn)
+        conn.commit()
+        report['registered'] += len(found)
+
+
+def shard_uploads(conn, folder: str, batch_size: int = MIGRATE_BATCH_SIZE) -> dict:
+    """Move uploads stored under flat names to their blob_name() paths.
+
+    New paths are hard links (or copies), and each batch's files are in
+    place before its rows change, so a crash never leaves a row pointing
+    at a missing file; the next run finds the file already there and only
+    redoes the rows. Once nothing references the old files the garbage
+    collector removes them. Rewriting posts.image lets the refcount
+    triggers move each reference to the new uploads row.
+    """
+    report = {'sharded': 0, 'unsharded_missing': 0}
+    last = ''
+    while True:
+        rows = conn.execute(
+            """
+            SELECT * FROM uploads
+            WHERE name > ? AND name NOT GLOB '[0-9a-f][0-9a-f]/[0-9a-f][0-9a-f]/*'
+            ORDER BY name LIMIT ?
+            """,
+            (last, batch_size),
+        ).fetchall()
+        if not rows:
+            return report
+        last = rows[-1]['name']
+        moves, new_rows = [], []
+        for row in rows:
+            old = row['name']
+            new = blob_name(row['digest'], os.path.splitext(old)[1])
+            src, dest = os.path.join(folder, old), os.path.join(folder, new)
+            if not os.path.exists(dest):
+                if not os.path.isfile(src):
+                    report['unsharded_missing'] += 1
+                    continue
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                try:
+                    os.link(src, dest)
+                except OSError:
+                    shutil.copy2(src, dest)
+            new_rows.append((new, row['digest'], row['size'], row['created_at'], row['width'], row['height'], row['placeholder']))
+            moves.append((new, old))
+        conn.executemany(
+            """
+            INSERT OR IGNORE INTO uploads (name, digest, size, refcount, created_at, width, height, placeholder)
+            VALUES (?, ?, ?, 0, ?, ?, ?, ?)
+            """,
+            new_rows,
+        )
+        conn.executemany('UPDATE posts SET image = ? WHERE image = ?', moves)
+        # Existing variant files stay where they are; only their source moves
+        conn.executemany('UPDATE OR REPLACE image_variants SET source = ? WHERE source = ?', moves)
+        conn.executemany('UPDATE OR REPLACE processed_images SET source = ? WHERE source = ?', moves)
+        conn.executemany('DELETE FROM uploads WHERE name = ?', [(old,) for _, old in moves])
+        jobs.heartbeat(conn)
+        conn.commit()
+        report['sharded'] += len(moves)
+
+
+def sniff_image_type(head: bytes):
+    """Return the stored extension for an image's first bytes, or None."""
+    for signature, ext in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return '.webp'
+    return None
+
+
+class IncomingFile:
+    """Writable target for one streamed multipart file part.
+
+    Chunks go straight to a temp file in the incoming folder while the
+    SHA-256 is updated and the leading bytes are sniffed, so memory use
+    stays at one chunk whatever the file size. Going over max_bytes, or
+    content that is not an accepted image, aborts the request as soon as
+    it is seen.
+    """
+
+    def __init__(self, folder: str, incoming: str, max_bytes=None):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.path = new_temp_path(incoming)
+        self.size = 0
+        self.ext = None
+        self._head = b''
+        self._sha256 = hashlib.sha256()
+        self._fh = open(self.path, 'w+b')
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            self.discard()
+            raise RequestEntityTooLarge(f'Uploaded files are limited to {self.max_bytes} bytes.')
+        if len(self._head) < SNIFF_BYTES:
+            self._head += data[:SNIFF_BYTES - len(self._head)]
+            if len(self._head) == SNIFF_BYTES:
+                self.ext = sniff_image_type(self._head)
+                if self.ext is None:
+                    self.discard()
+                    raise UnsupportedMediaType('Only PNG, JPEG, GIF and WebP images can be uploaded.')
+        self._sha256.update(data)
+        self._fh.write(data)
+        return len(data)
+
+    def hexdigest(self) -> str:
+        return self._sha256.hexdigest()
+
+    def read(self, size: int = -1) -> bytes:
+        return self._fh.read(size)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self._fh.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._fh.tell()
+
+    def close(self) -> None:
+        self.discard()
+
+    def discard(self) -> None:
+        """Close the temp file and remove it unless it was ingested."""
+        if not self._fh.closed:
+            self._fh.close()
+        if self.path is not None:
+            _remove(self.path)
+            self.path = None
+
+    def ingest(self, conn, prepare=None) -> str:
+        """Move the finished file into the store; returns its blob name.
+
+        prepare(path), if given, may rewrite the temp file first and
+        returns True when it did.
+        """
+        if self.ext is None:
+            self.discard()
+            raise UnsupportedMediaType('Only PNG, JPEG, GIF and WebP images can be uploaded.')
+        self._fh.close()
+        digest = self.hexdigest()
+        if prepare is not None and prepare(self.path):
+            digest = None
+        name = ingest_file(conn, self.folder, self.path, self.ext, digest)
+        self.path = None
+        return name
+
+
+class ChunkedUpload:
+    """A resumable upload assembled from chunks sent in separate requests.
+
+    State lives next to the other temp files in the incoming folder:
+    <id>.part holds the bytes received so far (its size is the resume
+    offset) and <id>.json the declared size. Each chunk must start at the
+    current offset and match its checksum, so a retried or duplicated chunk
+    is rejected rather than appended twice. finalize() hashes the file into
+    the store like any other upload.
+    """
+
+    ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+    CHECKSUMS = {
+        'sha256': lambda data: hashlib.sha256(data).hexdigest(),
+        'crc32': lambda data: f'{zlib.crc32(data):08x}',
+    }
+
+    def __init__(self, folder: str, incoming: str, upload_id: str, size: int):
+        self.folder = folder
+        self.incoming = incoming
+        self.id = upload_id
+        self.size = size
+        base = os.path.join(incoming, upload_id)
+        self.part_path = base + '.part'
+        self.meta_path = base + '.json'
+
+    @classmethod
+    def create(cls, folder: str, incoming: str, size: int, max_bytes=None):
+        if size <= 0:
+            raise BadRequest('Upload size must be positive.')
+        if max_bytes is not None and size > max_bytes:
+            raise RequestEntityTooLarge(f'Uploaded files are limited to {max_bytes} bytes.')
+        os.makedirs(incoming, exist_ok=True)
+        upload = cls(folder, incoming, secrets.token_hex(16), size)
+        with open(upload.meta_path, 'w') as fh:
+            json.dump({'size': size, 'created_at': time.time()}, fh)
+        open(upload.part_path, 'wb').close()
+        return upload
+
+    @classmethod
+    def load(cls, folder: str, incoming: str, upload_id: str):
+        if not cls.ID_PATTERN.match(upload_id):
+            raise NotFound()
+        try:
+            with open(os.path.join(incoming, upload_id + '.json')) as fh:
+                meta = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            raise NotFound('Unknown or expired upload.') from None
+        return cls(folder, incoming, upload_id, meta['size'])
+
+    @property
+    def offset(self) -> int:
+        try:
+            return os.path.getsize(self.part_path)
+        except FileNotFoundError:
+            raise NotFound('Unknown or expired upload.') from None
+
+    def status(self) -> dict:
+        offset = self.offset
+        return {'id': self.id, 'size': self.size, 'offset': offset, 'complete': offset == self.size}
+
+    def write_chunk(self, offset: int, data: bytes, checksum: str) -> int:
+        """Append data at offset after checking it; returns the new offset.
+
+        checksum is '<algorithm>=<hex>' with sha256 or crc32.
+        """
+        algorithm, _, expected = (checksum or '').partition('=')
+        if algorithm not in self.CHECKSUMS or not expected:
+            raise BadRequest('A chunk checksum (sha256=<hex> or crc32=<hex>) is required.')
+        if self.CHECKSUMS[algorithm](data) != expected.lower():
+            raise BadRequest('Chunk checksum mismatch.')
+        # Held across the offset check and the write so parallel retries cannot interleave
+        with file_lock(self.meta_path):
+            current = self.offset
+            if offset != current:
+                raise Conflict(f'Expected offset {current}.')
+            if current + len(data) > self.size:
+                raise RequestEntityTooLarge('Chunk goes past the declared upload size.')
+            if current == 0 and sniff_image_type(data[:SNIFF_BYTES]) is None:
+                self.discard()
+                raise UnsupportedMediaType('Only PNG, JPEG, GIF and WebP images can be uploaded.')
+            with open(self.part_path, 'ab') as fh:
+                fh.write(data)
+            return current + len(data)
+
+    def finalize(self, conn, prepare=None) -> str:
+        """Move the complete file into the store; returns its blob name.
+
+        prepare is as for IncomingFile.ingest().
+        """
+        with file_lock(self.meta_path):
+            if self.offset != self.size:
+                raise Conflict(f'Upload incomplete: {self.offset} of {self.size} bytes received.')
+            with open(self.part_path, 'rb') as fh:
+                ext = sniff_image_type(fh.read(SNIFF_BYTES))
+            if ext is None:
+                self.discard()
+                raise UnsupportedMediaType('Only PNG, JPEG, GIF and WebP images can be uploaded.')
+            if prepare is not None:
+                try:
+                    prepare(self.part_path)
+                except UnsupportedMediaType:
+                    self.discard()
+                    raise
+            name = ingest_file(conn, self.folder, self.part_path, ext)
+            _remove(self.meta_path)
+        return name
+
+    def discard(self) -> None:
+        _remove(self.part_path)
+        _remove(self.meta_path)
+
+
+def iter_files(directory: str, skip=(), _prefix: str = ''):
+    """Yield (relative name, stat) for every file below directory.
+
+    Hidden entries are left out, which keeps .incoming and in-progress temp
+    files apart from stored blobs; skip names top-level directories to leave
+    out as well.
+    """
+    try:
+        entries = os.scandir(directory)
+    except FileNotFoundError:
+        return
+    with entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if not (_prefix == '' and entry.name in skip):
+                    yield from iter_files(entry.path, _prefix=f'{_prefix}{entry.name}/')
+            elif entry.is_file(follow_symlinks=False):
+                yield _prefix + entry.name, entry.stat(follow_symlinks=False)
+
+
+def _scan_old_files(directory: str, cutoff: float, skip=()):
+    for name, stat in iter_files(directory, skip):
+        if stat.st_mtime < cutoff:
+            yield name, stat.st_size
+
+
+def _batches(items, size: int):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _remove(path: str) -> bool:
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def _prune_empty_dirs(directory: str, names) -> None:
+    """Remove the shard directories of deleted names that are now empty."""
+    parents = {os.path.dirname(name) for name in names}
+    # Deepest first, so 'ab/cd' goes before 'ab' is tried
+    for parent in sorted(parents, key=lambda p: p.count('/'), reverse=True):
+        while parent:
+            try:
+                os.rmdir(os.path.join(directory, parent))
+            except OSError:
+                break  # not empty (or already gone)
+            parent = os.path.dirname(parent)
+
+
+def collect_garbage(conn, folder: str, grace_seconds: float, dry_run: bool = True, incoming=None) -> dict:
+    """Find, and unless dry_run delete, uploads no post references.
+
+    Only files older than the grace period are considered, which protects
+    uploads whose post is still being saved. A blob is live while its
+    uploads row has a refcount above zero (the posts triggers maintain it);
+    only files with no row yet, from before content addressing, are looked
+    up in posts.image. Variants are kept while their source is.
+
+    Each batch is checked, forgotten and unlinked inside BEGIN IMMEDIATE,
+    and only names whose rows were still unreferenced at that point are
+    unlinked. A post saved meanwhile either commits first and keeps its
+    blob, or waits and re-stores the file. Shard directories left empty
+    are removed after. Abandoned temp files in the incoming folder (and in
+    the old one inside folder) go too.
+    """
+    cutoff = time.time() - grace_seconds
+    report = {'scanned': 0, 'orphans': 0, 'reclaimable_bytes': 0, 'deleted': 0, 'dry_run': dry_run}
+
+    def still_old(directory, name):
+        try:
+            return os.stat(os.path.join(directory, name)).st_mtime < cutoff
+        except FileNotFoundError:
+            return False
+
+    def sweep(directory, candidates, find_live, forget):
+        for batch in _batches(candidates, GC_BATCH_SIZE):
+            report['scanned'] += len(batch)
+            if dry_run:
+                live = find_live([name for name, _ in batch])
+                orphans = [(name, size) for name, size in batch if name not in live]
+                report['orphans'] += len(orphans)
+                report['reclaimable_bytes'] += sum(size for _, size in orphans)
+                continue
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                live = find_live([name for name, _ in batch])
+                # Re-stat: a dedup hit in ingest_file() refreshes the mtime
+                orphans = [(name, size) for name, size in batch if name not in live and still_old(directory, name)]
+                report['orphans'] += len(orphans)
+                report['reclaimable_bytes'] += sum(size for _, size in orphans)
+                removed = forget([name for name, _ in orphans]) if orphans else []
+                for name in removed:
+                    report['deleted'] += _remove(os.path.join(directory, name))
+                jobs.heartbeat(conn)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            _prune_empty_dirs(directory, removed)
+
+    def placeholders(names):
+        return ', '.join('?' for _ in names)
+
+    def live_blobs(names):
+        refcounts = dict(conn.execute(
+            f'SELECT name, refcount FROM uploads WHERE name IN ({placeholders(names)})', names
+        ).fetchall())
+        live = {name for name, refcount in refcounts.items() if refcount > 0}
+        untracked = [name for name in names if name not in refcounts]
+        if untracked:
+            rows = conn.execute(
+                f'SELECT DISTINCT image FROM posts WHERE image IN ({placeholders(untracked)})', untracked
+            ).fetchall()
+            live.update(row[0] for row in rows)
+        return live
+
+    def forget_blobs(names):
+        tracked = {row[0] for row in conn.execute(
+            f'SELECT name FROM uploads WHERE name IN ({placeholders(names)})', names
+        )}
+        deleted = {row[0] for row in conn.execute(
+            f'DELETE FROM uploads WHERE name IN ({placeholders(names)}) AND refcount <= 0 RETURNING name', names
+        )}
+        # Untracked files were just looked up in posts within this transaction
+        removed = [name for name in names if name in deleted or name not in tracked]
+        conn.execute(f'DELETE FROM image_variants WHERE source IN ({placeholders(removed)})', removed)
+        conn.execute(f'DELETE FROM processed_images WHERE source IN ({placeholders(removed)})', removed)
+        return removed
+
+    variants_dir = os.path.join(folder, VARIANTS_DIRNAME)
+
+    def live_variants(names):
+        paths = [f'{VARIANTS_DIRNAME}/{name}' for name in names]
+        rows = conn.execute(
+            f"""
+            SELECT v.filename FROM image_variants v
+            LEFT JOIN uploads u ON u.name = v.source
+            WHERE v.filename IN ({placeholders(paths)})
+              AND (u.refcount > 0 OR (u.name IS NULL AND EXISTS (SELECT 1 FROM posts p WHERE p.image = v.source)))
+            """,
+            paths,
+        ).fetchall()
+        return {row[0][len(VARIANTS_DIRNAME) + 1:] for row in rows}
+
+    def forget_variants(names):
+        paths = [f'{VARIANTS_DIRNAME}/{name}' for name in names]
+        conn.execute(f'DELETE FROM image_variants WHERE filename IN ({placeholders(paths)})', paths)
+        return names
+
+    sweep(folder, _scan_old_files(folder, cutoff, skip=(VARIANTS_DIRNAME,)), live_blobs, forget_blobs)
+    sweep(variants_dir, _scan_old_files(variants_dir, cutoff), live_variants, forget_variants)
+
+    # Temp files abandoned by interrupted uploads
+    for staging in (incoming, os.path.join(folder, INCOMING_DIRNAME)):
+        if staging:
+            sweep(staging, _scan_old_files(staging, cutoff), lambda names: set(), lambda names: names)
+    return report